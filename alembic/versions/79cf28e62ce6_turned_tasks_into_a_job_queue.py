@@ -0,0 +1,77 @@
+"""turned tasks into a job queue
+
+Revision ID: 79cf28e62ce6
+Revises: e1fe2d2de21a
+Create Date: 2026-10-17 13:41:52.671940
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '79cf28e62ce6'
+down_revision = 'e1fe2d2de21a'
+branch_labels = None
+depends_on = None
+
+COLUMNS = (
+    'guild_id, message_id, channel_id, time, function, user_id, '
+    'moderator_id, reason, worker_id, lease_expires'
+)
+
+
+def _create_indexes():
+    op.create_index('ix_tasks_time', 'tasks', ['time'], unique=False)
+    op.create_index('ix_tasks_guild_id_time', 'tasks', ['guild_id', 'time'], unique=False)
+    op.create_index('ix_tasks_lease_expires', 'tasks', ['lease_expires'], unique=False)
+
+
+def upgrade():
+    # SQLite can't change a primary key in place, so the table is rebuilt.
+    op.create_table('tasks_new',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('guild_id', sa.Integer(), nullable=True),
+    sa.Column('message_id', sa.Integer(), nullable=True),
+    sa.Column('channel_id', sa.Integer(), nullable=True),
+    sa.Column('time', sa.DateTime(), nullable=False),
+    sa.Column('function', sa.String(length=32), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.Column('moderator_id', sa.Integer(), nullable=True),
+    sa.Column('reason', sa.String(length=512), nullable=True),
+    sa.Column('payload', sa.JSON(), nullable=True),
+    sa.Column('interval', sa.Integer(), nullable=True),
+    sa.Column('key', sa.String(length=64), nullable=True),
+    sa.Column('worker_id', sa.String(length=64), nullable=True),
+    sa.Column('lease_expires', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('key')
+    )
+    op.execute(f'INSERT INTO tasks_new ({COLUMNS}) SELECT {COLUMNS} FROM tasks')
+    op.drop_table('tasks')
+    op.rename_table('tasks_new', 'tasks')
+    _create_indexes()
+
+
+def downgrade():
+    op.create_table('tasks_old',
+    sa.Column('guild_id', sa.Integer(), nullable=True),
+    sa.Column('message_id', sa.Integer(), nullable=False),
+    sa.Column('channel_id', sa.Integer(), nullable=True),
+    sa.Column('time', sa.DateTime(), nullable=False),
+    sa.Column('function', sa.String(length=32), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.Column('moderator_id', sa.Integer(), nullable=True),
+    sa.Column('reason', sa.String(length=512), nullable=True),
+    sa.Column('worker_id', sa.String(length=64), nullable=True),
+    sa.Column('lease_expires', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('message_id')
+    )
+    # Jobs without a command message can't be kept in the old table.
+    op.execute(
+        f'INSERT OR IGNORE INTO tasks_old ({COLUMNS}) SELECT {COLUMNS} FROM tasks '
+        'WHERE message_id IS NOT NULL'
+    )
+    op.drop_table('tasks')
+    op.rename_table('tasks_old', 'tasks')
+    _create_indexes()
@@ -0,0 +1,49 @@
+"""Helpers shared by the benchmarks."""
+import os
+import sys
+import tempfile
+import contextlib
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+@contextlib.contextmanager
+def temporary_config(config="", database=""):
+    """Runs waffle against a throwaway config.toml and SQLite database.
+
+    waffle.config reads config.toml from the working directory on import, so
+    this has to be entered before anything from waffle is imported.
+    """
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        Path(directory, "config.toml").write_text(
+            f"""
+[bot]
+token = ''
+prefix = 'waf '
+extensions = []
+
+[config]
+mute = 'Muted'
+log_channel = 'mod-log'
+{config}
+
+[database]
+uri = 'sqlite+aiosqlite:///{Path(directory, "bench.db")}'
+{database}
+"""
+        )
+        os.chdir(directory)
+        try:
+            yield directory
+        finally:
+            os.chdir(cwd)
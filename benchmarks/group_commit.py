@@ -0,0 +1,87 @@
+"""Compares committing every task insert on its own with group commit.
+
+"before" opens a transaction per insert, like set_task used to, on a
+rollback-journal database. "after" sends the same inserts through
+waffle.database.write on a WAL database. Each mode runs in its own process
+because waffle reads its config once on import.
+
+Usage: python benchmarks/group_commit.py [--writers 50] [--writes 20]
+"""
+import sys
+import time
+import asyncio
+import argparse
+import datetime
+import subprocess
+
+from common import percentile, temporary_config
+
+MODES = {
+    "before": "wal = false",
+    "after": "wal = true\ncommit_delay = 5",
+}
+
+
+async def run(mode, writers, writes):
+    import waffle.database
+    from waffle.tables import TasksTable
+
+    async with waffle.database.engine.begin() as conn:
+        await conn.run_sync(waffle.database.metadata.create_all)
+
+    async def insert(job):
+        if mode == "before":
+            async with waffle.database.engine.begin() as conn:
+                await conn.execute(TasksTable.insert(), job)
+        else:
+            await waffle.database.write(TasksTable.insert(), job)
+
+    latencies = []
+
+    async def writer(number):
+        for i in range(writes):
+            job = {
+                "function": "unmute",
+                "time": datetime.datetime.now(),
+                "guild_id": number,
+                "user_id": i,
+            }
+            start = time.perf_counter()
+            await insert(job)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(writer(number) for number in range(writers)))
+    elapsed = time.perf_counter() - start
+    print(
+        f"{mode:<7} {writers * writes / elapsed:10.0f} inserts/s"
+        f"   p50 {percentile(latencies, 0.5) * 1000:7.1f}ms"
+        f"   p99 {percentile(latencies, 0.99) * 1000:7.1f}ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--writers", type=int, default=50)
+    parser.add_argument("--writes", type=int, default=20)
+    parser.add_argument("--mode", choices=MODES)
+    args = parser.parse_args()
+
+    if args.mode is None:
+        print(f"{args.writers} concurrent writers, {args.writes} inserts each")
+        for mode in MODES:
+            subprocess.run(
+                [sys.executable, __file__, "--mode", mode]
+                + ["--writers", str(args.writers), "--writes", str(args.writes)],
+                check=True,
+            )
+        return
+
+    with temporary_config(database=MODES[args.mode]):
+        asyncio.get_event_loop().run_until_complete(
+            run(args.mode, args.writers, args.writes)
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,327 @@
+"""Latency and cost of the whole music pipeline, at several guild counts.
+
+Each guild plays a song, queues a few more at once, moves and removes some,
+and skips through loop and repeat mode before letting its queue play out,
+all through the Music cog's commands. Songs are played in real time with
+discord.py's AudioPlayer into a fake voice client that drops the packets.
+youtube_dl's extract_info is replaced by a stub that finds songs in a
+catalog of --catalog songs and serves the same generated sample from a
+local HTTP server, for streaming and downloading alike, so everything from
+searching to caching runs offline, ffmpeg included.
+
+Every guild count runs in its own process, since waffle reads its config
+once on import. It reports how long commands took, the time to first audio
+and between songs, how many packets were sent late, and the CPU time and
+peak memory it took.
+
+Needs ffmpeg with libopus.
+
+Usage: python benchmarks/pipeline.py --guilds 1 10 100 --seconds 5
+"""
+import sys
+import time
+import types
+import shutil
+import asyncio
+import argparse
+import resource
+import threading
+import subprocess
+from collections import defaultdict
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+from common import percentile, temporary_config
+
+# Songs each guild queues after the first one, with one play command.
+QUEUED = 5
+
+
+class FakeVoice:
+    """Stands in for discord.VoiceClient, sending packets nowhere."""
+
+    def __init__(self, channel, loop):
+        self.channel = channel
+        self.loop = loop
+        self._connected = threading.Event()
+        self._connected.set()
+        self.ws = types.SimpleNamespace(speak=self.speak)
+        self._player = None
+
+    async def speak(self, speaking):
+        pass
+
+    def send_audio_packet(self, data, *, encode=True):
+        # When AudioPlayer meant to send it.
+        import waffle.metrics
+
+        player = self._player
+        if player is None:
+            return
+        late = time.perf_counter() - player._start - player.DELAY * player.loops
+        waffle.metrics.increment("packets")
+        if late > 0.02:
+            waffle.metrics.increment("packets_late_20ms")
+
+    def is_connected(self):
+        return self._connected.is_set()
+
+    def play(self, source, *, after=None):
+        import discord
+
+        if self.is_playing():
+            raise discord.ClientException("Already playing audio.")
+        self._player = discord.player.AudioPlayer(source, self, after=after)
+        self._player.start()
+
+    def is_playing(self):
+        return self._player is not None and self._player.is_playing()
+
+    def is_paused(self):
+        return self._player is not None and self._player.is_paused()
+
+    @property
+    def source(self):
+        return self._player.source if self._player else None
+
+    @source.setter
+    def source(self, value):
+        self._player._set_source(value)
+
+    def stop(self):
+        if self._player:
+            self._player.stop()
+            self._player = None
+
+    def pause(self):
+        if self._player:
+            self._player.pause()
+
+    def resume(self):
+        if self._player:
+            self._player.resume()
+
+    async def disconnect(self, *, force=False):
+        self.stop()
+        self._connected.clear()
+        self.channel.guild.voice_client = None
+
+
+class Message:
+    async def edit(self, **kwargs):
+        pass
+
+    async def add_reaction(self, emoji):
+        pass
+
+
+class TextChannel:
+    async def send(self, *args, **kwargs):
+        return Message()
+
+
+class VoiceChannel:
+    def __init__(self, guild):
+        self.guild = guild
+
+    async def connect(self, *, cls=None):
+        self.guild.voice_client = FakeVoice(self, asyncio.get_event_loop())
+        return self.guild.voice_client
+
+
+def context(bot, guild_id):
+    guild = types.SimpleNamespace(id=guild_id, voice_client=None)
+    channel = TextChannel()
+    author = types.SimpleNamespace(
+        id=guild_id,
+        name=f"user {guild_id}",
+        mention=f"<@{guild_id}>",
+        avatar_url="",
+        voice=types.SimpleNamespace(channel=VoiceChannel(guild)),
+    )
+    return types.SimpleNamespace(
+        bot=bot, guild=guild, channel=channel, author=author, send=channel.send
+    )
+
+
+def stub_extractor(args, port):
+    """Returns an extract_info finding songs in the catalog."""
+    import waffle.music
+    import waffle.audio_cache
+
+    def info(number):
+        video_id = f"song{number:07d}"
+        return {
+            "id": video_id,
+            "webpage_url": f"https://www.youtube.com/watch?v={video_id}",
+            "title": f"Song {number}",
+            "duration": args.seconds,
+            "uploader": "Uploader",
+            "channel_url": "https://www.youtube.com/channel/0",
+            "artist": None,
+            "url": f"http://127.0.0.1:{port}/sample.opus",
+        }
+
+    def extract_info(self, url, download=True, **kwargs):
+        time.sleep(args.extractor_delay)
+        if url.startswith("ytsearch:"):
+            return {"entries": [info(int(url.split()[-1]) % args.catalog)]}
+        found = info(int(url.rsplit("song", 1)[1]))
+        if download:
+            for hook in self._progress_hooks:
+                hook({"status": "downloading"})
+            # youtube_dl makes the directory of its output template.
+            waffle.audio_cache.DOWNLOADS.mkdir(parents=True, exist_ok=True)
+            path = waffle.audio_cache.DOWNLOADS / f"{found['id']}.opus"
+            shutil.copy("sample.opus", path)
+            waffle.music.ApplyGain(self).run({"filepath": str(path), **found})
+        return found
+
+    return extract_info
+
+
+async def session(cog, ctx, args, latencies):
+    """One guild's use of the music commands."""
+
+    async def command(name, **kwargs):
+        start = time.perf_counter()
+        await cog.cog_before_invoke(ctx)
+        await getattr(cog, name).callback(cog, ctx, **kwargs)
+        await cog.cog_after_invoke(ctx)
+        latencies[name].append(time.perf_counter() - start)
+
+    def song(number):
+        return f"song {(ctx.guild.id + number) % args.catalog}"
+
+    await command("play", request=song(0))
+    await command("play", request="\n".join(song(n) for n in range(1, QUEUED + 1)))
+    await asyncio.sleep(args.seconds / 2)
+    await command("play_next", position=3)
+    await command("play_later", position=1)
+    await command("remove", position=2)
+    await command("loop")
+    await command("skip")
+    await asyncio.sleep(1)
+    await command("skip")
+    await command("loop")
+    await command("repeat")
+    await asyncio.sleep(1)
+    await command("skip")
+    await command("repeat")
+    # What's left plays out, then the last song is stopped halfway.
+    while ctx.music_state.queue:
+        await asyncio.sleep(0.5)
+    await asyncio.sleep(args.seconds / 2)
+    await command("stop")
+
+
+async def run(args):
+    import waffle.music
+    import waffle.metrics
+    import waffle.database
+
+    async with waffle.database.engine.begin() as conn:
+        await conn.run_sync(waffle.database.metadata.create_all)
+
+    subprocess.run(
+        ["ffmpeg", "-loglevel", "error", "-f", "lavfi"]
+        + ["-i", f"sine=frequency=440:duration={args.seconds}"]
+        + ["-ac", "2", "-c:a", "libopus", "-b:a", "128k", "sample.opus"],
+        check=True,
+    )
+    handler = type(
+        "Handler", (SimpleHTTPRequestHandler,), {"log_message": lambda *args: None}
+    )
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    import youtube_dl
+
+    youtube_dl.YoutubeDL.extract_info = stub_extractor(args, server.server_port)
+
+    loop = asyncio.get_event_loop()
+    cogs = []
+    bot = types.SimpleNamespace(
+        loop=loop, user=types.SimpleNamespace(id=0), add_cog=cogs.append
+    )
+    waffle.music.setup(bot)
+    (cog,) = cogs
+
+    latencies = defaultdict(list)
+    start = time.perf_counter()
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    await asyncio.gather(
+        *(
+            session(cog, context(bot, guild_id), args, latencies)
+            for guild_id in range(1, args.guilds + 1)
+        )
+    )
+    elapsed = time.perf_counter() - start
+    # Lets the players' threads and the ffmpeg processes finish.
+    await asyncio.sleep(1)
+    server.shutdown()
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    ffmpeg = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = usage.ru_utime + usage.ru_stime - own.ru_utime - own.ru_stime
+    ffmpeg_cpu = ffmpeg.ru_utime + ffmpeg.ru_stime
+    timings = waffle.metrics.timings
+    counters = waffle.metrics.counters
+
+    def distribution(samples):
+        return (
+            f"p50 {percentile(samples, 0.5) * 1000:7.1f} ms"
+            f"  p95 {percentile(samples, 0.95) * 1000:7.1f} ms"
+            f"  max {max(samples, default=0) * 1000:7.1f} ms  (n={len(samples)})"
+        )
+
+    print(f"{args.guilds} guilds, {elapsed:.1f}s")
+    for name, samples in sorted(latencies.items()):
+        print(f"  {name:<26} {distribution(samples)}")
+    for name in (
+        "time_to_first_audio_stream",
+        "time_to_first_audio_cache",
+        "track_gap",
+    ):
+        print(f"  {name:<26} {distribution(timings.get(name, []))}")
+    packets = counters["packets"] or 1
+    print(f"  packets >20 ms late        {counters['packets_late_20ms'] / packets:.2%}")
+    print(
+        f"  CPU, % of a core           bot {cpu / elapsed:.1%}"
+        f"  ffmpeg {ffmpeg_cpu / elapsed:.1%}"
+        f"  per guild {(cpu + ffmpeg_cpu) / elapsed / args.guilds:.2%}"
+    )
+    # ru_maxrss is in kilobytes on Linux.
+    print(f"  peak memory                {usage.ru_maxrss / 1024:.0f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--guilds", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--seconds", type=int, default=5, help="song length")
+    parser.add_argument("--catalog", type=int, default=50)
+    parser.add_argument(
+        "--extractor-delay",
+        type=float,
+        default=0,
+        help="seconds each stubbed youtube_dl call takes",
+    )
+    args = parser.parse_args()
+
+    if len(args.guilds) > 1:
+        for guilds in args.guilds:
+            subprocess.run(
+                [sys.executable, __file__, "--guilds", str(guilds)]
+                + ["--seconds", str(args.seconds), "--catalog", str(args.catalog)]
+                + ["--extractor-delay", str(args.extractor_delay)],
+                check=True,
+            )
+        return
+
+    args.guilds = args.guilds[0]
+    config = f"queue_capacity = {QUEUED + 1}\nmusic_idle_timeout = 3600"
+    with temporary_config(config=config):
+        asyncio.get_event_loop().run_until_complete(run(args))
+
+
+if __name__ == "__main__":
+    main()
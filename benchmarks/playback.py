@@ -0,0 +1,111 @@
+"""CPU cost of playing a cached song through each playback path.
+
+Opens the same opus file on several concurrent streams per path with
+GuildMusicState.source and reads its frames as fast as ffmpeg produces them.
+It then reports the CPU time (this process plus ffmpeg) per second of audio,
+which is the share of a core one real-time stream needs.
+
+  pcm          FFmpegPCMAudio + PCMVolumeTransformer, then opus encoding in
+               discord.py (the old path; the encoding needs libopus)
+  opus-copy    FFmpegOpusAudio passing the packets through (default volume)
+  opus-filter  FFmpegOpusAudio with an ffmpeg volume filter (other volumes)
+
+Needs ffmpeg with libopus. Runs fully offline.
+
+Usage: python benchmarks/playback.py --streams 10 --seconds 60
+"""
+import time
+import asyncio
+import argparse
+import resource
+import subprocess
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+from common import temporary_config
+
+# Path: (opus passthrough, volume relative to the default).
+PATHS = {
+    "pcm": (False, 0.5),
+    "opus-copy": (True, 1),
+    "opus-filter": (True, 0.5),
+}
+
+
+def cpu_seconds():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def play(source, encoder):
+    """Reads a source to the end like discord.py's player, minus the waiting."""
+    frames = 0
+    while True:
+        data = source.read()
+        if not data:
+            break
+        if encoder and not source.is_opus():
+            encoder.encode(data, encoder.SAMPLES_PER_FRAME)
+        frames += 1
+    source.cleanup()
+    return frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--streams", type=int, default=10)
+    parser.add_argument("--seconds", type=int, default=60, help="song length")
+    parser.add_argument("--paths", nargs="+", choices=PATHS, default=list(PATHS))
+    args = parser.parse_args()
+
+    with temporary_config(config="queue_capacity = 100") as directory:
+        import discord
+        import waffle.music
+
+        song = types.SimpleNamespace(
+            stream_url=None, downloaded=True, filename=f"{directory}/song.opus"
+        )
+        subprocess.run(
+            ["ffmpeg", "-loglevel", "error", "-f", "lavfi"]
+            + ["-i", f"sine=frequency=440:duration={args.seconds}"]
+            + ["-ac", "2", "-c:a", "libopus", "-b:a", "128k", song.filename],
+            check=True,
+        )
+
+        ctx = types.SimpleNamespace(
+            bot=None, guild=types.SimpleNamespace(voice_client=None), channel=None
+        )
+        state = waffle.music.GuildMusicState(ctx, asyncio.get_event_loop())
+
+        print(f"{args.streams} concurrent streams of a {args.seconds}s song")
+        for path in args.paths:
+            waffle.music.OPUS_PASSTHROUGH, volume = PATHS[path]
+            state.volume = waffle.music.DEFAULT_VOLUME * volume
+            encoders = [None] * args.streams
+            note = ""
+            if path == "pcm":
+                try:
+                    encoders = [discord.opus.Encoder() for _ in range(args.streams)]
+                except discord.opus.OpusNotLoaded:
+                    note = "  (libopus not found, encoding not included)"
+
+            cpu = cpu_seconds()
+            start = time.perf_counter()
+            sources = [state.source(song) for _ in range(args.streams)]
+            with ThreadPoolExecutor(max_workers=args.streams) as pool:
+                frames = sum(pool.map(play, sources, encoders))
+            wall = time.perf_counter() - start
+            cpu = cpu_seconds() - cpu
+
+            audio = frames * discord.opus.Encoder.FRAME_LENGTH / 1000
+            print(
+                "{:<12} {:6.2f}s CPU for {:6.0f}s of audio in {:5.2f}s  "
+                "-> {:5.2f}% of a core per stream{}".format(
+                    path, cpu, audio, wall, cpu / audio * 100, note
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""Cost of saving music queues and of restoring them after a restart.
+
+Fills --guilds queues of --songs songs each through GuildMusicState, as
+playlists would, and plays a few songs in each so some changes are left
+after the last compaction, every --compact-every changes. It reports the
+CPU time per recorded change and how long the writes took to commit, then
+the time to load every saved queue back from the database and to restore
+them all into fresh states, which the bot does lazily, one guild at a time.
+Every loaded queue is checked against the queue that was saved.
+
+Usage: python benchmarks/queue_store.py --guilds 1000 --songs 50 --compact-every 20
+"""
+import time
+import types
+import asyncio
+import argparse
+
+from common import temporary_config
+
+
+async def send(*args, **kwargs):
+    pass
+
+
+def context(guild_id):
+    return types.SimpleNamespace(
+        bot=None,
+        guild=types.SimpleNamespace(id=guild_id, voice_client=None),
+        channel=types.SimpleNamespace(send=send),
+    )
+
+
+async def run(args):
+    import waffle.music
+    import waffle.metrics
+    import waffle.database
+    import waffle.queue_store
+
+    async with waffle.database.engine.begin() as conn:
+        await conn.run_sync(waffle.database.metadata.create_all)
+    loop = asyncio.get_event_loop()
+    # Nothing is resolved or downloaded ahead of time.
+    waffle.music.PREFETCH = 0
+
+    start = time.process_time()
+    wall = time.perf_counter()
+    states = {}
+    for guild_id in range(1, args.guilds + 1):
+        state = states[guild_id] = waffle.music.GuildMusicState(context(guild_id), loop)
+        for number in range(args.songs):
+            video_id = f"{guild_id:05d}{number:06d}"
+            state.add_to_queue(
+                waffle.music.Song(
+                    f"https://www.youtube.com/watch?v={video_id}",
+                    123456789012345678,
+                    video_id=video_id,
+                    title=f"Song number {number}",
+                )
+            )
+        for _ in range(args.plays):
+            state.set_current_song(state.next_song_info())
+        # Lets the writes of each guild go out as they would between commands.
+        await asyncio.sleep(0)
+    cpu = time.process_time() - start
+    await waffle.database.flush()
+    wall = time.perf_counter() - wall
+    counters = waffle.metrics.counters
+    changes = args.guilds * (args.songs + 2 * args.plays)
+    print(f"{changes} changes to {args.guilds} queues")
+    print(f"  CPU per change       {cpu / changes * 1e6:8.1f} us")
+    print(f"  committed in         {wall:8.2f} s")
+    print(f"  compactions          {counters['queue_store_compactions']:8d}")
+
+    start = time.perf_counter()
+    saved = await waffle.queue_store.load()
+    loaded = time.perf_counter() - start
+    assert len(saved) == args.guilds, f"{len(saved)} queues loaded"
+    for guild_id, state in states.items():
+        dump = state.dump()
+        for key in ("mode", "current", "songs"):
+            assert saved[guild_id][key] == dump[key], f"guild {guild_id}'s {key}"
+    start = time.perf_counter()
+    for guild_id, state in saved.items():
+        waffle.music.GuildMusicState(context(guild_id), loop).restore(state)
+    restored = time.perf_counter() - start
+    await waffle.database.flush()
+    print(f"{len(saved)} queues restored")
+    print(f"  loaded in            {loaded * 1000:8.1f} ms")
+    print(f"  restored in          {restored * 1000:8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--guilds", type=int, default=1000)
+    parser.add_argument("--songs", type=int, default=50)
+    parser.add_argument("--plays", type=int, default=3)
+    parser.add_argument("--compact-every", type=int, default=20)
+    args = parser.parse_args()
+
+    config = (
+        f"queue_capacity = {args.songs}\nqueue_compact_every = {args.compact_every}"
+    )
+    with temporary_config(config=config):
+        asyncio.get_event_loop().run_until_complete(run(args))
+
+
+if __name__ == "__main__":
+    main()
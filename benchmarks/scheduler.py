@@ -0,0 +1,243 @@
+"""Load and latency benchmark for waffle.scheduler.
+
+Seeds the tasks table of a throwaway SQLite database with tempmutes and
+tempbans spread over a time range, then runs them through the real scheduler
+and moderation handlers against a stub Discord layer. Runs fully offline.
+
+The clock is virtual: whenever the scheduler would sleep, the clock jumps
+straight to the next deadline, but time spent working (database queries,
+stub REST calls) still advances it. Dispatch lag is therefore what a task
+would see in production minus the idle waiting.
+
+Stub REST calls really sleep for --latency, and every tick costs real
+database time, so the run time grows with the number of distinct deadlines.
+Use a short --span to simulate a burst (e.g. expiry after a raid).
+
+Usage: python benchmarks/scheduler.py --tasks 10000 --span 10
+"""
+import time
+import random
+import asyncio
+import argparse
+import datetime
+import resource
+import functools
+import tracemalloc
+
+from common import percentile, temporary_config
+
+
+class Clock:
+    """Virtual time that only moves with real work or explicit jumps."""
+
+    def __init__(self, start):
+        self.base = start
+        self.started = time.perf_counter()
+
+    def now(self):
+        elapsed = time.perf_counter() - self.started
+        return self.base + datetime.timedelta(seconds=elapsed)
+
+    def jump(self, to):
+        if to > self.now():
+            self.base = to
+            self.started = time.perf_counter()
+
+
+def virtual_datetime(clock):
+    class VirtualDatetime(datetime.datetime):
+        @classmethod
+        def now(cls, tz=None):
+            if tz is not None:
+                return datetime.datetime.now(tz)
+            return clock.now()
+
+    return VirtualDatetime
+
+
+class Stub:
+    """Anything with an id, enough for mentions and audit log reasons."""
+
+    def __init__(self, id, **attributes):
+        self.id = id
+        self.name = f"stub-{id}"
+        self.mention = f"<@{id}>"
+        self.avatar_url = ""
+        self.__dict__.update(attributes)
+
+
+class FakeRest:
+    """Counts requests and adds a fixed latency to each of them."""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.requests = 0
+
+    async def __call__(self):
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+
+
+class FakeGuild(Stub):
+    def __init__(self, id, rest, mute_name, log_name):
+        self.rest = rest
+        self.mute_role = Stub(id + 1, name=mute_name)
+        self.log_channel = Stub(id + 2, name=log_name, send=self.send)
+        super().__init__(
+            id, roles=[self.mute_role], channels=[self.log_channel], me=Stub(0)
+        )
+
+    def get_member(self, user_id):
+        return Stub(user_id, roles=[self.mute_role], remove_roles=self.remove_roles)
+
+    async def remove_roles(self, *roles, reason=None):
+        await self.rest()
+
+    async def unban(self, user, reason=None):
+        await self.rest()
+
+    async def send(self, embed=None):
+        await self.rest()
+
+
+def timed(function, samples):
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await function(*args, **kwargs)
+        finally:
+            samples.append(time.perf_counter() - start)
+
+    return wrapper
+
+
+async def run(args):
+    import waffle
+    import waffle.database
+    import waffle.moderation
+    import waffle.scheduler as scheduler
+
+    start = datetime.datetime(2030, 1, 1)
+    clock = Clock(start)
+    scheduler.datetime = type(
+        "datetime",
+        (),
+        {
+            "datetime": virtual_datetime(clock),
+            "timedelta": datetime.timedelta,
+            "timezone": datetime.timezone,
+        },
+    )
+
+    rest = FakeRest(args.latency / 1000)
+    guilds = {
+        guild_id: FakeGuild(guild_id, rest, "Muted", "mod-log")
+        for guild_id in range(1000, 1000 + args.guilds * 10, 10)
+    }
+    waffle.bot.get_guild = guilds.get
+    waffle.bot.get_user = lambda user_id: None
+
+    lags = []
+
+    def measure(handler):
+        async def wrapper(task):
+            lags.append((clock.now() - task["time"]).total_seconds())
+            await handler(task)
+
+        return wrapper
+
+    scheduler.register("unmute", measure(waffle.moderation.unmute_task))
+    scheduler.register("unban", measure(waffle.moderation.unban_task))
+
+    db_samples = []
+    for name in ("claim_due_tasks", "finish_tasks", "next_task_time"):
+        setattr(scheduler, name, timed(getattr(scheduler, name), db_samples))
+
+    async with waffle.database.engine.begin() as conn:
+        await conn.run_sync(waffle.database.metadata.create_all)
+
+    seed_start = time.perf_counter()
+    jobs = [
+        {
+            "function": random.choice(("unmute", "unban")),
+            "time": start + datetime.timedelta(seconds=random.uniform(0, args.span)),
+            "guild_id": random.choice(list(guilds)),
+            "user_id": random.randint(1, 10**9),
+            "moderator_id": 1,
+            "message_id": i,
+        }
+        for i in range(args.tasks)
+    ]
+    for i in range(0, len(jobs), 10000):
+        await scheduler.schedule_many(jobs[i : i + 10000])
+    seed_time = time.perf_counter() - seed_start
+    del jobs
+
+    tracemalloc.start()
+    ticks = []
+    run_start = time.perf_counter()
+    while True:
+        db_before = len(db_samples)
+        tick_start = time.perf_counter()
+        await scheduler.check_for_tasks()
+        ticks.append((time.perf_counter() - tick_start, sum(db_samples[db_before:])))
+        if not scheduler._heap:
+            break
+        clock.jump(scheduler._heap[0])
+    run_time = time.perf_counter() - run_start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    db_per_tick = [db for _, db in ticks]
+    print(f"tasks             {args.tasks} over {args.span}s in {args.guilds} guilds")
+    print(f"seeded in         {seed_time:.2f}s")
+    print(f"dispatched        {len(lags)} in {run_time:.2f}s ({len(ticks)} ticks)")
+    print(f"REST requests     {rest.requests} at {args.latency}ms each")
+    print(
+        "dispatch lag      p50 {:.1f}ms  p99 {:.1f}ms  max {:.1f}ms".format(
+            percentile(lags, 0.5) * 1000,
+            percentile(lags, 0.99) * 1000,
+            max(lags, default=0) * 1000,
+        )
+    )
+    print(
+        "DB time per tick  mean {:.2f}ms  p99 {:.2f}ms  max {:.2f}ms".format(
+            sum(db_per_tick) / len(db_per_tick) * 1000,
+            percentile(db_per_tick, 0.99) * 1000,
+            max(db_per_tick) * 1000,
+        )
+    )
+    print(f"traced peak       {peak / 2**20:.1f} MiB while dispatching")
+    print(
+        "max RSS           {:.1f} MiB".format(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tasks", type=int, default=1000)
+    parser.add_argument("--span", type=float, default=3600, help="seconds")
+    parser.add_argument("--guilds", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=20, help="ms per request")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--per-guild", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    with temporary_config(
+        database=f"""
+batch_size = {args.batch_size}
+max_concurrent_tasks = {args.concurrency}
+max_concurrent_tasks_per_guild = {args.per_guild}
+"""
+    ):
+        asyncio.get_event_loop().run_until_complete(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""Checks that worker processes sharing one tasks table run every task once.
+
+Seeds --tasks tasks that are due right away into a throwaway SQLite
+database, then runs them through waffle.scheduler in --workers processes at
+once. The first worker is killed while it holds a claimed batch: its handler
+never finishes, so the batch is only ever run by the others, once its
+leases expire. Each task appends its number to its worker's log when it
+finishes, and the run fails unless every task was logged exactly once. A
+task logged twice means two live workers held it at the same time.
+
+--failing more tasks, due first, always fail. They have to be retried only
+once their lease expires, without holding up the others.
+
+Usage: python benchmarks/scheduler_workers.py --workers 4 --tasks 2000 --failing 50
+"""
+import sys
+import time
+import signal
+import socket
+import asyncio
+import argparse
+import datetime
+import subprocess
+from pathlib import Path
+from collections import Counter
+
+from common import temporary_config
+
+# Short, so the killed worker's batch is picked up again quickly.
+LEASE = 2
+DATABASE = f"""
+lease_duration = {LEASE}
+resync_interval = 0.5
+batch_size = 20
+max_concurrent_tasks = 20
+max_concurrent_tasks_per_guild = 20
+"""
+
+
+async def work(args):
+    """Runs tasks until killed, in the directory of the parent's database."""
+    import waffle.scheduler
+
+    log = open(f"ran-{args.worker}.txt", "a", buffering=1)
+
+    async def handler(task):
+        if args.victim:
+            Path("claimed.txt").write_text(str(task["payload"]))
+            # Killed before any of its batch is done.
+            await asyncio.Event().wait()
+        await asyncio.sleep(args.task_time)
+        log.write(f"{task['payload']}\n")
+
+    async def fail(task):
+        failures.write(f"{task['payload']}\n")
+        raise RuntimeError("failing on purpose")
+
+    failures = open(f"failed-{args.worker}.txt", "a", buffering=1)
+    waffle.scheduler.register("count", handler)
+    waffle.scheduler.register("fail", fail)
+    await waffle.scheduler.start()
+
+
+def start_worker(args, number, victim=False):
+    return subprocess.Popen(
+        [sys.executable, str(Path(__file__).resolve()), "--worker", str(number)]
+        + ["--task-time", str(args.task_time)]
+        + (["--victim"] if victim else [])
+    )
+
+
+async def remaining_tasks(worker_id=None):
+    """Counts the tasks left that don't fail, or those claimed by `worker_id`."""
+    import waffle.database
+    from sqlalchemy.sql import select, func
+    from waffle.tables import TasksTable
+
+    query = (
+        select(func.count())
+        .select_from(TasksTable)
+        .where(TasksTable.c.function == "count")
+    )
+    if worker_id:
+        query = query.where(TasksTable.c.worker_id == worker_id)
+    async with waffle.database.engine.begin() as conn:
+        return await conn.scalar(query)
+
+
+async def run(args):
+    import waffle.database
+    import waffle.scheduler
+
+    async with waffle.database.engine.begin() as conn:
+        await conn.run_sync(waffle.database.metadata.create_all)
+    now = datetime.datetime.now()
+    await waffle.scheduler.schedule_many(
+        [
+            {
+                "function": "fail",
+                "time": now - datetime.timedelta(seconds=1),
+                "guild_id": None,
+                "payload": number,
+            }
+            for number in range(args.failing)
+        ]
+        + [
+            {"function": "count", "time": now, "guild_id": None, "payload": number}
+            for number in range(args.tasks)
+        ]
+    )
+
+    start = time.perf_counter()
+    victim = start_worker(args, 0, victim=True)
+    while not Path("claimed.txt").exists():
+        await asyncio.sleep(0.01)
+    workers = [start_worker(args, number) for number in range(1, args.workers)]
+    await asyncio.sleep(0.5)
+    held = await remaining_tasks(f"{socket.gethostname()}-{victim.pid}")
+    victim.send_signal(signal.SIGKILL)
+    victim.wait()
+    killed = time.perf_counter() - start
+
+    try:
+        deadline = time.perf_counter() + args.timeout
+        while await remaining_tasks():
+            if time.perf_counter() > deadline:
+                raise SystemExit(f"{await remaining_tasks()} tasks never finished")
+            await asyncio.sleep(0.1)
+        elapsed = time.perf_counter() - start
+    finally:
+        for worker in workers:
+            worker.terminate()
+            worker.wait()
+
+    runs = Counter()
+    for log in Path().glob("ran-*.txt"):
+        runs.update(int(line) for line in log.read_text().split())
+    missing = [number for number in range(args.tasks) if number not in runs]
+    twice = [number for number, count in runs.items() if count > 1]
+    failures = Counter()
+    for log in Path().glob("failed-*.txt"):
+        failures.update(int(line) for line in log.read_text().split())
+    # Once when first due, then once per lease, give or take one.
+    retries = int(elapsed // LEASE) + 2
+    too_often = [number for number, count in failures.items() if count > retries]
+    print(f"{args.tasks} tasks, {args.workers} workers, one killed at {killed:.1f}s")
+    print(f"  killed holding   {held:6d}")
+    print(f"  done in          {elapsed:6.2f} s")
+    print(f"  never run        {len(missing):6d}")
+    print(f"  run twice        {len(twice):6d}")
+    print(
+        f"  failing tasks    {args.failing:6d}"
+        f", tried up to {max(failures.values(), default=0)} times"
+    )
+    assert not missing and not twice, "tasks weren't run exactly once"
+    assert not too_often, f"failing tasks retried more than {retries} times"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--tasks", type=int, default=2000)
+    parser.add_argument("--failing", type=int, default=50)
+    parser.add_argument(
+        "--task-time", type=float, default=0.01, help="seconds each task takes"
+    )
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    parser.add_argument("--victim", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        # Started by run, in its temporary directory.
+        asyncio.get_event_loop().run_until_complete(work(args))
+        return
+
+    with temporary_config(database=DATABASE):
+        asyncio.get_event_loop().run_until_complete(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""Micro-benchmark of the music queue operations, SongQueue against a deque.
+
+Each operation runs at random positions of a queue holding --size songs
+(and is undone where needed, so the size stays the same). The deque column
+includes the positions play_next_song and the queue command used to write
+onto every song.
+
+Usage: python benchmarks/song_queue.py --size 10000
+"""
+import time
+import random
+import argparse
+from collections import deque
+
+from common import temporary_config
+
+
+class Song:
+    position = None
+
+
+def per_call(function, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def operations(queue, size, index_of):
+    songs = list(queue)
+
+    def get():
+        queue[random.randrange(size)]
+
+    def insert_and_remove():
+        song = Song()
+        queue.insert(random.randrange(size), song)
+        del queue[index_of(queue, song)]
+
+    def move():
+        # playnext: to the front, then back to where it was.
+        index = random.randrange(size)
+        song = queue[index]
+        del queue[index]
+        queue.insert(0, song)
+        del queue[0]
+        queue.insert(index, song)
+
+    def position():
+        index_of(queue, random.choice(songs))
+
+    def popleft_append():
+        # What loop mode does for every song.
+        queue.append(queue.popleft())
+
+    return {
+        "get by position": get,
+        "insert + remove": insert_and_remove,
+        "move to front": move,
+        "position of song": position,
+        "popleft + append": popleft_append,
+    }
+
+
+def renumber(queue):
+    for index, song in enumerate(queue):
+        song.position = index + 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=2000)
+    args = parser.parse_args()
+
+    with temporary_config():
+        from waffle.song_queue import SongQueue
+
+        songs = [Song() for _ in range(args.size)]
+        old = deque(songs)
+        new = SongQueue(songs)
+        old_operations = operations(
+            old, args.size, lambda queue, song: queue.index(song)
+        )
+        new_operations = operations(
+            new, args.size, lambda queue, song: queue.index(song)
+        )
+
+        print(f"{args.size} songs, microseconds per call")
+        print(f"{'':<20} {'deque':>10} {'SongQueue':>10}")
+        for name in old_operations:
+            random.seed(0)
+            before = per_call(old_operations[name], args.repeat)
+            random.seed(0)
+            after = per_call(new_operations[name], args.repeat)
+            print(f"{name:<20} {before:>10.1f} {after:>10.1f}")
+        before = per_call(lambda: renumber(old), 20)
+        print(f"{'renumber positions':<20} {before:>10.1f} {'-':>10}")
+
+
+if __name__ == "__main__":
+    main()
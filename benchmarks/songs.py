@@ -0,0 +1,91 @@
+"""Memory per queued song and CPU per resolved song.
+
+Queues --songs playlist entries as placeholders and measures the memory they
+take (with tracemalloc), then again once each is resolved from song info like
+the song cache's. It then times --plays songs going through what play does
+off the event loop, searching for the song and loading what was found.
+
+youtube_dl's extract_info is replaced by a stub returning made-up info, so
+this runs offline and counts only waffle's own work and youtube_dl's setup.
+
+Usage: python benchmarks/songs.py --songs 10000 --plays 500
+"""
+import gc
+import time
+import argparse
+import tracemalloc
+
+from common import temporary_config
+
+
+def info(number):
+    video_id = f"{number:011d}"
+    return {
+        "id": video_id,
+        "webpage_url": f"https://www.youtube.com/watch?v={video_id}",
+        "title": f"Song number {number}",
+        "duration": 180 + number % 120,
+        "uploader": f"Uploader {number % 100}",
+        "channel_url": f"https://www.youtube.com/channel/{number % 100:024d}",
+        "artist": None,
+        # Only search results come with a media URL, see GuildMusicState.resolve.
+        "url": f"https://example.invalid/{video_id}",
+    }
+
+
+def stub_extract_info(self, url, download=True, **kwargs):
+    if url.startswith("ytsearch:"):
+        return {"entries": [info(int(url.split()[-1]))]}
+    return info(0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--songs", type=int, default=10000)
+    parser.add_argument("--plays", type=int, default=500)
+    args = parser.parse_args()
+
+    with temporary_config(config="queue_capacity = 100"):
+        import youtube_dl
+        import waffle.music
+        from waffle.song_queue import SongQueue
+
+        youtube_dl.YoutubeDL.extract_info = stub_extract_info
+        requester_id = 123456789012345678
+
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        queue = SongQueue()
+        for number in range(args.songs):
+            entry = info(number)
+            queue.append(
+                waffle.music.Song(
+                    f"https://www.youtube.com/watch?v={entry['id']}",
+                    requester_id,
+                    video_id=entry["id"],
+                    title=entry["title"],
+                )
+            )
+        placeholders = tracemalloc.get_traced_memory()[0] - before
+        for number, song in enumerate(queue):
+            song.load(info(number))
+        gc.collect()
+        resolved = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+
+        print(f"{args.songs} queued songs, bytes per song (queue included)")
+        print(f"  placeholders {placeholders / args.songs:8.0f}")
+        print(f"  resolved     {resolved / args.songs:8.0f}")
+
+        start = time.process_time()
+        for number in range(args.plays):
+            song = waffle.music.Song(f"song {number}", requester_id)
+            song.load(waffle.music.find(waffle.music.Job(), song.query))
+        cpu = time.process_time() - start
+        print(f"{args.plays} songs searched and looked up")
+        print(f"  CPU per song {cpu / args.plays * 1000:8.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""Compares fetching due tasks with a full table scan against the indexed range query.
+
+Usage: python benchmarks/tasks_query.py [pending tasks] [due tasks]
+"""
+import sys
+import time
+import random
+import sqlite3
+import datetime
+import tempfile
+from pathlib import Path
+
+PENDING = int(sys.argv[1]) if len(sys.argv) > 1 else 500_000
+DUE = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+LIMIT = 100
+RUNS = 20
+
+
+def seed(path):
+    now = datetime.datetime.now()
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE tasks (guild_id INTEGER, message_id INTEGER PRIMARY KEY, "
+        "channel_id INTEGER, time DATETIME NOT NULL, function VARCHAR(32) NOT NULL, "
+        "user_id INTEGER)"
+    )
+    rows = []
+    for i in range(PENDING + DUE):
+        if i < DUE:
+            offset = -random.randint(1, 60)
+        else:
+            offset = random.randint(60, 5 * 31536000)
+        rows.append(
+            (
+                random.randint(1, 1000),
+                i,
+                1,
+                str(now + datetime.timedelta(seconds=offset)),
+                random.choice(("unmute", "unban")),
+                i,
+            )
+        )
+    conn.executemany("INSERT INTO tasks VALUES (?, ?, ?, ?, ?, ?)", rows)
+    conn.commit()
+    return conn
+
+
+def full_scan(conn, now):
+    return [
+        row
+        for row in conn.execute("SELECT * FROM tasks")
+        if datetime.datetime.fromisoformat(row[3]) <= now
+    ]
+
+
+def range_query(conn, now):
+    return conn.execute(
+        "SELECT * FROM tasks WHERE time <= ? ORDER BY time LIMIT ?", (str(now), LIMIT)
+    ).fetchall()
+
+
+def bench(name, function, conn):
+    now = datetime.datetime.now()
+    start = time.perf_counter()
+    for _ in range(RUNS):
+        found = function(conn, now)
+    elapsed = (time.perf_counter() - start) / RUNS
+    print(f"{name:<28} {elapsed * 1000:10.3f} ms/tick  ({len(found)} due)")
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        conn = seed(str(Path(directory, "tasks.db")))
+        print(f"{PENDING} pending tasks, {DUE} due")
+        bench("full scan", full_scan, conn)
+        bench("range query (no index)", range_query, conn)
+        conn.execute("CREATE INDEX ix_tasks_time ON tasks (time)")
+        conn.execute("CREATE INDEX ix_tasks_guild_id_time ON tasks (guild_id, time)")
+        bench("range query (indexed)", range_query, conn)
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,364 @@
+"""Streams per core when playing from the bot's process and from audio workers.
+
+Plays a cached song on --streams guilds at once, in real time, through
+discord.py's AudioPlayer and VoiceClient.send_audio_packet, to a local UDP
+port that discards the packets instead of a Discord voice server:
+
+  in-process  every guild's player thread in this process, like the bot
+              without audio workers
+  workers     guilds connected with RemoteVoiceClient to --workers audio
+              worker processes (waffle.audio_worker)
+
+It reports the CPU time (every process, ffmpeg included) per stream, and so
+about how many streams one core plays, the share of packets sent more than 5
+and 20 ms after they were due, and how late this process' event loop wakes
+up, which is what commands wait on.
+
+  crash       plays through GuildMusicState in workers and kills them
+              halfway; every song has to be queued first again and play
+              once the guild reconnects
+
+Needs ffmpeg with libopus. Without PyNaCl, packets are sent unencrypted.
+Runs fully offline.
+
+Usage: python benchmarks/voice_workers.py --streams 20 --seconds 30 --workers 2
+"""
+import os
+import sys
+import time
+import types
+import socket
+import asyncio
+import argparse
+import resource
+import subprocess
+from pathlib import Path
+
+from common import percentile, temporary_config
+
+USER_ID = 1
+
+
+def cpu_seconds():
+    """CPU time of this process, and of its children that have exited."""
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (
+        own.ru_utime + own.ru_stime,
+        children.ru_utime + children.ru_stime,
+    )
+
+
+def synthetic_voice_class():
+    """Returns a VoiceClient that is connected right away to the local sink."""
+    import discord
+    import discord.voice_client
+    import waffle.metrics
+    import waffle.audio_worker
+
+    encrypted = discord.voice_client.has_nacl
+    # The check in VoiceClient.__init__; packets are left unencrypted instead.
+    discord.voice_client.has_nacl = True
+
+    class SyntheticVoice(waffle.audio_worker.WorkerVoiceClient):
+        async def connect(self, *, timeout, reconnect):
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.socket.setblocking(False)
+            self.endpoint_ip = "127.0.0.1"
+            self.voice_port = int(os.environ["VOICE_SINK_PORT"])
+            self.ssrc = self.guild.id
+            self.mode = "xsalsa20_poly1305_lite"
+            self.secret_key = bytes(32)
+            self.ws = types.SimpleNamespace(speak=self.speak)
+            self._connected.set()
+
+        async def speak(self, speaking):
+            pass
+
+        async def disconnect(self, *, force=False):
+            self.stop()
+            self._connected.clear()
+            self.socket.close()
+            self.cleanup()
+
+        def _get_voice_packet(self, data):
+            if encrypted:
+                return super()._get_voice_packet(data)
+            return bytes(12) + data
+
+        def send_audio_packet(self, data, *, encode=True):
+            # When AudioPlayer meant to send it.
+            player = self._player
+            late = time.perf_counter() - player._start - player.DELAY * player.loops
+            waffle.metrics.increment("packets")
+            if late > 0.005:
+                waffle.metrics.increment("packets_late_5ms")
+            if late > 0.02:
+                waffle.metrics.increment("packets_late_20ms")
+            super().send_audio_packet(data, encode=encode)
+
+    SyntheticVoice.encrypted = encrypted
+    return SyntheticVoice
+
+
+class Guild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+
+    def get_channel(self, channel_id):
+        return types.SimpleNamespace(
+            id=channel_id,
+            guild=self,
+            _get_voice_client_key=lambda: (self.id, "guild_id"),
+        )
+
+    async def change_voice_state(self, *, channel):
+        pass
+
+
+async def measure_lag(lags, done):
+    """Records how late the event loop wakes up from 10 ms sleeps."""
+    while not done.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.01)
+        lags.append(time.perf_counter() - start - 0.01)
+
+
+async def play_in_process(args, filename, voice_class):
+    import waffle.music
+    import waffle.metrics
+
+    loop = asyncio.get_event_loop()
+    connection = types.SimpleNamespace(
+        loop=loop,
+        user=types.SimpleNamespace(id=USER_ID),
+        http=None,
+        _remove_voice_client=lambda guild_id: None,
+    )
+    server = types.SimpleNamespace(loop=loop, connection=lambda user_id: connection)
+    ended = []
+    for guild_id in range(1, args.streams + 1):
+        voice = voice_class(server, guild_id, guild_id, USER_ID)
+        await voice.connect(timeout=5, reconnect=False)
+        source = waffle.music.open_source(filename, "cache", 1, args.volume)
+        finished = asyncio.Event()
+        voice.play(
+            source,
+            after=lambda error, finished=finished: loop.call_soon_threadsafe(
+                finished.set
+            ),
+        )
+        ended.append((voice, finished))
+    for voice, finished in ended:
+        await finished.wait()
+        await voice.disconnect()
+    return dict(waffle.metrics.counters)
+
+
+def use_workers(args):
+    """Has guilds play from --workers workers. Returns their client."""
+    import waffle.audio_worker
+
+    waffle.audio_worker.WORKERS = args.workers
+    waffle.audio_worker.COMMAND = [
+        sys.executable,
+        str(Path(__file__).resolve()),
+        "--worker",
+    ]
+    return types.SimpleNamespace(
+        loop=asyncio.get_event_loop(),
+        user=types.SimpleNamespace(id=USER_ID),
+        _connection=types.SimpleNamespace(_remove_voice_client=lambda key: None),
+    )
+
+
+async def connect_remote(client, guild_id):
+    import waffle.audio_worker
+
+    voice = waffle.audio_worker.RemoteVoiceClient(
+        client, Guild(guild_id).get_channel(guild_id)
+    )
+    await voice.connect(timeout=5, reconnect=False)
+    return voice
+
+
+async def play_in_workers(args, filename):
+    import waffle.audio_worker
+
+    client = use_workers(args)
+    ended = []
+    for guild_id in range(1, args.streams + 1):
+        voice = await connect_remote(client, guild_id)
+        source = voice.open_source(filename, "cache", 1, args.volume)
+        finished = asyncio.Event()
+        voice.play(source, after=lambda error, finished=finished: finished.set())
+        ended.append((voice, finished))
+    for voice, finished in ended:
+        await finished.wait()
+        await voice.disconnect()
+
+    counters = {}
+    workers = list(waffle.audio_worker._workers.values())
+    for worker in workers:
+        reply = await worker.request("metrics")
+        for name, value in reply["counters"].items():
+            counters[name] = counters.get(name, 0) + value
+    waffle.audio_worker.shutdown()
+    for worker in workers:
+        await worker.process.wait()
+    return counters
+
+
+async def send(*args, **kwargs):
+    pass
+
+
+async def crash_workers(args):
+    """Kills the workers halfway through the guilds' songs, then reconnects."""
+    import waffle.music
+    import waffle.audio_cache
+    import waffle.audio_worker
+
+    loop = asyncio.get_event_loop()
+    client = use_workers(args)
+    states = {}
+    for guild_id in range(1, args.streams + 1):
+        ctx = types.SimpleNamespace(
+            bot=None,
+            guild=types.SimpleNamespace(id=guild_id, voice_client=None),
+            channel=types.SimpleNamespace(send=send),
+        )
+        state = states[guild_id] = waffle.music.GuildMusicState(ctx, loop)
+        song = waffle.music.Song(f"song {guild_id}", USER_ID)
+        song.load({"id": f"song{guild_id:07d}", "duration": args.seconds})
+        song.downloaded = True
+        state.voice = await connect_remote(client, guild_id)
+        state.add_to_queue(song)
+        await state.play_next_song(state.next_song_info())
+
+    await asyncio.sleep(min(1, args.seconds / 2))
+    workers = list(waffle.audio_worker._workers.values())
+    for worker in workers:
+        worker.process.kill()
+    for worker in workers:
+        await worker.process.wait()
+    # Lets the workers' exits reach the guilds.
+    deadline = time.perf_counter() + 5
+    while any(state.voice for state in states.values()):
+        assert time.perf_counter() < deadline, "guilds still think they're connected"
+        await asyncio.sleep(0.05)
+    requeued = [
+        state
+        for state in states.values()
+        if not state.current_song and len(state.queue) == 1
+    ]
+
+    for guild_id, state in states.items():
+        state.voice = await connect_remote(client, guild_id)
+        if not state.current_song:
+            await state.play_next_song(state.next_song_info())
+    await asyncio.sleep(0.5)
+    playing = [state for state in states.values() if state.voice.is_playing()]
+    for state in states.values():
+        await state.voice.disconnect()
+        state.cleanup()
+    waffle.audio_worker.shutdown()
+
+    print(f"crash ({args.streams} guilds, {len(workers)} workers killed)")
+    print(f"  songs queued first again  {len(requeued):4d}")
+    print(f"  playing after reconnect   {len(playing):4d}")
+    assert len(requeued) == len(playing) == args.streams, "songs were lost"
+
+
+def run(mode, args, filename, voice_class):
+    loop = asyncio.get_event_loop()
+    lags = []
+    done = asyncio.Event()
+    lag = loop.create_task(measure_lag(lags, done))
+    own_before, children_before = cpu_seconds()
+    if mode == "in-process":
+        counters = loop.run_until_complete(play_in_process(args, filename, voice_class))
+    else:
+        counters = loop.run_until_complete(play_in_workers(args, filename))
+    done.set()
+    loop.run_until_complete(lag)
+    own, children = cpu_seconds()
+    own -= own_before
+    cpu = own + children - children_before
+
+    per_stream = cpu / (args.seconds * args.streams)
+    packets = counters.get("packets", 0) or 1
+    late_5ms = counters.get("packets_late_5ms", 0) / packets
+    late_20ms = counters.get("packets_late_20ms", 0) / packets
+    print(f"{mode} ({args.streams} streams)")
+    print(f"  CPU per stream         {per_stream * 100:6.2f} % of a core")
+    print(f"  streams per core       {1 / per_stream if per_stream else 0:6.0f}")
+    print(f"  this process' CPU      {own / args.seconds * 100:6.2f} % of a core")
+    print(f"  packets >5 ms late     {late_5ms * 100:6.2f} %")
+    print(f"  packets >20 ms late    {late_20ms * 100:6.2f} %")
+    print(
+        f"  event loop lag         p50 {percentile(lags, 0.5) * 1000:.1f} ms"
+        f"  p99 {percentile(lags, 0.99) * 1000:.1f} ms"
+        f"  max {max(lags, default=0) * 1000:.1f} ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--streams", type=int, default=20)
+    parser.add_argument("--seconds", type=int, default=30, help="song length")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument(
+        "--volume",
+        type=float,
+        default=1,
+        help="relative to the cached volume; 1 passes the opus through",
+    )
+    parser.add_argument(
+        "--modes",
+        nargs="+",
+        choices=["in-process", "workers", "crash"],
+        default=["in-process", "workers", "crash"],
+    )
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        # Started by play_in_workers, in its temporary directory.
+        import waffle.audio_worker
+
+        waffle.audio_worker.serve(synthetic_voice_class())
+        return
+
+    config = "queue_capacity = 100\npersist_queues = false"
+    with temporary_config(config=config) as directory:
+        voice_class = synthetic_voice_class()
+        if not voice_class.encrypted:
+            print("PyNaCl isn't installed, packets are sent unencrypted\n")
+
+        filename = f"{directory}/song.opus"
+        subprocess.run(
+            ["ffmpeg", "-loglevel", "error", "-f", "lavfi"]
+            + ["-i", f"sine=frequency=440:duration={args.seconds}"]
+            + ["-ac", "2", "-c:a", "libopus", "-b:a", "128k", filename],
+            check=True,
+        )
+        # Nothing reads it, so the kernel drops what it's sent.
+        sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sink.bind(("127.0.0.1", 0))
+        os.environ["VOICE_SINK_PORT"] = str(sink.getsockname()[1])
+
+        for mode in args.modes:
+            if mode == "crash":
+                import waffle.audio_cache
+
+                waffle.audio_cache.DIRECTORY.mkdir(exist_ok=True)
+                for guild_id in range(1, args.streams + 1):
+                    os.link(filename, waffle.audio_cache.path(f"song{guild_id:07d}"))
+                asyncio.get_event_loop().run_until_complete(crash_workers(args))
+            else:
+                run(mode, args, filename, voice_class)
+
+
+if __name__ == "__main__":
+    main()
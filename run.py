@@ -1,5 +1,3 @@
-import asyncio
-
 import waffle
 
 from discord.ext import commands
@@ -15,7 +13,7 @@ async def on_ready():
     print("*Waffles*")
     print("Logged in as")
     print(bot.user.id)
-    asyncio.ensure_future(waffle.scheduler.check_for_tasks())
+    waffle.scheduler.start()
 
 
 @bot.command()
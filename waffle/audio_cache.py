@@ -0,0 +1,175 @@
+"""Size-bounded cache of downloaded songs in the cache directory."""
+import os
+import time
+import asyncio
+from pathlib import Path
+
+import waffle.config
+import waffle.metrics
+
+CONFIG = waffle.config.CONFIG["config"]
+
+DIRECTORY = Path("cache")
+# Where songs are downloaded and converted before they're moved into the cache.
+DOWNLOADS = DIRECTORY / "downloads"
+# Bytes the cached songs may take up, and the policy picking which ones go.
+BUDGET = CONFIG.get("audio_cache_size", 1024) * 2**20
+POLICY = CONFIG.get("audio_cache_policy", "lru")
+# Evicting down to a bit below the budget keeps every new download from
+# evicting a song of its own.
+LOW_WATER = 0.9
+
+
+class Entry:
+    __slots__ = ("size", "last_access", "hits")
+
+    def __init__(self, size, last_access, hits=0):
+        self.size = size
+        self.last_access = last_access
+        self.hits = hits
+
+
+# Cached songs by video id.
+_index = {}
+_size = 0
+# Number of queued or playing songs per video id. Pinned songs aren't evicted.
+_pins = {}
+_evicting = None
+
+waffle.metrics.gauge("audio_cache_bytes", lambda: _size)
+waffle.metrics.gauge("audio_cache_files", lambda: len(_index))
+
+
+def path(video_id):
+    return DIRECTORY / (video_id + ".opus")
+
+
+def scan(version):
+    """Rebuilds the index from one pass over the cache directory.
+
+    `version` describes how the files are encoded. Files cached under another
+    version are deleted instead of indexed.
+    """
+    global _size
+    DIRECTORY.mkdir(exist_ok=True)
+    _index.clear()
+    # Left over from downloads cut short by a restart.
+    for file in [*DOWNLOADS.glob("*"), *DIRECTORY.glob("*.part")]:
+        file.unlink()
+    marker = DIRECTORY / ".version"
+    if not marker.exists() or marker.read_text() != version:
+        for file in DIRECTORY.glob("*.opus"):
+            file.unlink()
+        marker.write_text(version)
+    with os.scandir(DIRECTORY) as files:
+        for file in files:
+            if not file.name.endswith(".opus") or not file.is_file():
+                continue
+            stat = file.stat()
+            # Hits bump the mtime, so it orders files even with noatime.
+            _index[file.name[: -len(".opus")]] = Entry(
+                stat.st_size, max(stat.st_atime, stat.st_mtime)
+            )
+    _size = sum(entry.size for entry in _index.values())
+    _evict_soon()
+
+
+def lookup(video_id):
+    """Returns whether a song is cached, counting it as a hit if it is."""
+    entry = _index.get(video_id)
+    if entry is None:
+        return False
+    try:
+        os.utime(path(video_id))
+    except FileNotFoundError:
+        # Deleted behind the cache's back. Left in the index until the song is
+        # downloaded again, since this may run on a music thread.
+        return False
+    entry.hits += 1
+    entry.last_access = time.time()
+    waffle.metrics.increment("audio_cache_hits")
+    return True
+
+
+def cached(video_id):
+    """Returns whether a song is cached, without counting it as a hit."""
+    return video_id in _index
+
+
+def video_ids():
+    return list(_index)
+
+
+def add(video_id):
+    """Indexes a freshly downloaded song."""
+    global _size
+    waffle.metrics.increment("audio_cache_misses")
+    try:
+        size = path(video_id).stat().st_size
+    except FileNotFoundError:
+        return
+    _forget(video_id)
+    _index[video_id] = Entry(size, time.time())
+    _size += size
+    _evict_soon()
+
+
+def pin(video_id):
+    _pins[video_id] = _pins.get(video_id, 0) + 1
+
+
+def unpin(video_id):
+    if _pins.get(video_id, 0) > 1:
+        _pins[video_id] -= 1
+    else:
+        _pins.pop(video_id, None)
+
+
+def _forget(video_id):
+    global _size
+    entry = _index.pop(video_id, None)
+    if entry:
+        _size -= entry.size
+
+
+def _victims(target):
+    """Takes unpinned songs out of the index until it fits in `target` bytes."""
+    if POLICY == "lfu":
+        order = lambda item: (item[1].hits, item[1].last_access)
+    else:
+        order = lambda item: item[1].last_access
+    victims = []
+    for video_id, entry in sorted(_index.items(), key=order):
+        if _size <= target:
+            break
+        if video_id in _pins:
+            continue
+        _forget(video_id)
+        victims.append((video_id, entry.size))
+    return victims
+
+
+def _evict_soon():
+    global _evicting
+    if _size > BUDGET and (_evicting is None or _evicting.done()):
+        _evicting = asyncio.ensure_future(evict(BUDGET * LOW_WATER))
+
+
+async def evict(target=0):
+    """Deletes unpinned songs until the cache takes up at most `target` bytes.
+
+    The index is updated right away; the files are deleted off the event loop.
+    """
+    victims = _victims(target)
+    await asyncio.get_event_loop().run_in_executor(None, _delete, victims)
+    return len(victims)
+
+
+def _delete(victims):
+    for video_id, size in victims:
+        try:
+            path(video_id).unlink()
+        except FileNotFoundError:
+            continue
+        waffle.metrics.increment("audio_cache_evictions")
+        waffle.metrics.increment("audio_cache_evicted_bytes", size)
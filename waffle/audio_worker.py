@@ -0,0 +1,641 @@
+"""Worker processes playing guilds' music, away from the bot's event loop.
+
+With `audio_workers` set, guilds connect to voice with RemoteVoiceClient and
+their voice connection, ffmpeg sources and player thread live in one of that
+many worker processes, picked by guild id. The packets of busy guilds then
+don't compete for the bot's GIL with each other or with commands. The bot
+keeps the gateway connection and passes each worker its guilds' voice events,
+talking to it over its stdin and stdout, one JSON message per line.
+
+Workers are started with `python -m waffle.audio_worker`. The worker side
+drives discord.VoiceClient through discord.py's private voice internals, as
+they are in the 1.7 releases pyproject.toml pins.
+"""
+import os
+import sys
+import json
+import types
+import asyncio
+import resource
+import itertools
+import threading
+import traceback
+
+import aiohttp
+import discord
+from discord.gateway import DiscordClientWebSocketResponse
+
+import waffle.config
+import waffle.metrics
+
+CONFIG = waffle.config.CONFIG["config"]
+
+# Worker processes, 0 to play from the bot's own process.
+WORKERS = CONFIG.get("audio_workers", 0)
+if WORKERS and discord.version_info[:2] != (1, 7):
+    print(
+        f"audio_workers needs discord.py 1.7, not {discord.__version__}; "
+        "playing from the bot's process instead.",
+        file=sys.stderr,
+    )
+    WORKERS = 0
+COMMAND = [sys.executable, "-m", "waffle.audio_worker"]
+# Sent when opening voice websockets, as discord.py's HTTPClient does.
+USER_AGENT = (
+    "DiscordBot (https://github.com/Rapptz/discord.py {}) "
+    "Python/{}.{} aiohttp/{}".format(
+        discord.__version__, *sys.version_info[:2], aiohttp.__version__
+    )
+)
+
+# Workers by index, the index being guild id % WORKERS.
+_workers = {}
+_ids = itertools.count()
+
+waffle.metrics.gauge(
+    "audio_workers", lambda: sum(worker.alive() for worker in _workers.values())
+)
+
+
+def voice_client_class():
+    """Returns the class guilds connect to voice with."""
+    return RemoteVoiceClient if WORKERS else discord.VoiceClient
+
+
+async def worker_for(guild_id):
+    """Returns the worker playing a guild's music, started if it isn't."""
+    index = guild_id % WORKERS
+    worker = _workers.get(index)
+    if worker is None or not worker.alive():
+        worker = _workers[index] = Worker(COMMAND)
+    await worker.started
+    return worker
+
+
+def shutdown():
+    """Stops the workers, disconnecting their guilds."""
+    for worker in _workers.values():
+        worker.stop()
+    _workers.clear()
+
+
+class Worker:
+    """A worker process, as seen from the bot."""
+
+    def __init__(self, command):
+        self.loop = asyncio.get_event_loop()
+        self.process = None
+        # Voice clients connected or connecting through the worker, by guild id.
+        self.voices = {}
+        # Sources opened in the worker and not closed or ended yet, by id.
+        self.sources = {}
+        # Requests waiting for the worker's reply, by id.
+        self.requests = {}
+        self.started = asyncio.ensure_future(self.start(command))
+
+    async def start(self, command):
+        self.process = await asyncio.create_subprocess_exec(
+            *command,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+        )
+        waffle.metrics.increment("audio_workers_started")
+        asyncio.ensure_future(self.listen())
+
+    def alive(self):
+        if not self.started.done():
+            return True
+        return (
+            not self.started.exception()
+            and self.process.returncode is None
+            and not self.process.stdin.is_closing()
+        )
+
+    def post(self, **message):
+        """Sends a message to the worker. Can be called from any thread."""
+        line = json.dumps(message).encode() + b"\n"
+        self.loop.call_soon_threadsafe(self._write, line)
+
+    def _write(self, line):
+        if self.process.returncode is None and not self.process.stdin.is_closing():
+            self.process.stdin.write(line)
+
+    def stop(self):
+        # The worker exits once its stdin is closed.
+        if self.process and not self.process.stdin.is_closing():
+            self.process.stdin.close()
+
+    async def request(self, op, **message):
+        """Sends a message to the worker and returns its reply."""
+        request = next(_ids)
+        reply = self.requests[request] = self.loop.create_future()
+        self.post(op=op, request=request, **message)
+        return await reply
+
+    async def listen(self):
+        async for line in self.process.stdout:
+            message = json.loads(line)
+            try:
+                getattr(self, "on_" + message.pop("event"))(**message)
+            except Exception:
+                traceback.print_exc()
+        await self.process.wait()
+        # The worker exited, taking its guilds' voice connections with it.
+        for voice in list(self.voices.values()):
+            voice.gone()
+        for reply in self.requests.values():
+            reply.cancel()
+
+    def on_change_voice_state(self, guild, channel):
+        voice = self.voices.get(guild)
+        if voice:
+            asyncio.ensure_future(voice.change_voice_state(channel))
+
+    def on_connected(self, guild):
+        voice = self.voices.get(guild)
+        if voice and not voice.waiting.done():
+            voice.waiting.set_result(True)
+
+    def on_connect_failed(self, guild, timeout, error):
+        voice = self.voices.get(guild)
+        if voice and not voice.waiting.done():
+            if timeout:
+                voice.waiting.set_exception(asyncio.TimeoutError())
+            else:
+                voice.waiting.set_exception(discord.ClientException(error))
+
+    def on_disconnected(self, guild):
+        voice = self.voices.get(guild)
+        if voice:
+            voice.gone()
+
+    def on_ending(self, source):
+        source = self.sources.get(source)
+        if source and source.on_ending:
+            source.on_ending()
+
+    def on_ended(self, guild, source, error):
+        source = self.sources.pop(source, None)
+        voice = self.voices.get(guild)
+        if source and voice:
+            voice.ended(source, error)
+
+    def on_timing(self, name, seconds):
+        waffle.metrics.record(name, seconds)
+
+    def on_reply(self, request, **reply):
+        future = self.requests.pop(request, None)
+        if future and not future.done():
+            future.set_result(reply)
+
+
+class RemoteVoiceClient(discord.VoiceProtocol):
+    """A guild's voice connection, made and played by an audio worker.
+
+    Stands in for discord.VoiceClient as far as the music cog uses it. Whether
+    it is connected, playing or paused is mirrored here, so asking doesn't
+    wait for the worker.
+    """
+
+    def __init__(self, client, channel):
+        super().__init__(client, channel)
+        self.loop = client.loop
+        self.worker = None
+        self.connected = False
+        # Resolved by the worker's answer to connect or disconnect.
+        self.waiting = None
+        self._source = None
+        self.paused = False
+
+    @property
+    def guild(self):
+        return self.channel.guild
+
+    @property
+    def source(self):
+        return self._source
+
+    async def connect(self, *, timeout, reconnect):
+        self.worker = await worker_for(self.guild.id)
+        self.worker.voices[self.guild.id] = self
+        self.waiting = self.loop.create_future()
+        self.worker.post(
+            op="connect",
+            guild=self.guild.id,
+            channel=self.channel.id,
+            user=self.client.user.id,
+            timeout=timeout,
+            reconnect=reconnect,
+        )
+        try:
+            connected = await self.waiting
+        except discord.ClientException:
+            self.gone()
+            raise
+        if not connected:
+            raise discord.ClientException("The voice connection was closed.")
+        self.connected = True
+
+    async def change_voice_state(self, channel_id):
+        channel = self.guild.get_channel(channel_id) if channel_id else None
+        await self.guild.change_voice_state(channel=channel)
+
+    async def on_voice_state_update(self, data):
+        if data["channel_id"]:
+            channel = self.guild.get_channel(int(data["channel_id"]))
+            self.channel = channel or self.channel
+        self.worker.post(op="voice_state_update", guild=self.guild.id, data=data)
+
+    async def on_voice_server_update(self, data):
+        self.worker.post(op="voice_server_update", guild=self.guild.id, data=data)
+
+    async def disconnect(self, *, force=False):
+        if not force and not self.connected:
+            return
+        if self.worker.voices.get(self.guild.id) is not self:
+            return
+        self.waiting = self.loop.create_future()
+        self.worker.post(op="disconnect", guild=self.guild.id, force=force)
+        await self.waiting
+
+    def gone(self):
+        """Forgets the connection once the worker dropped it."""
+        self.connected = False
+        source, self._source = self._source, None
+        self.paused = False
+        if self.worker.voices.get(self.guild.id) is self:
+            del self.worker.voices[self.guild.id]
+        # Unless it was disconnected on purpose, the song was cut short.
+        requested = self.waiting is not None and not self.waiting.done()
+        if requested:
+            self.waiting.set_result(False)
+        self.cleanup()
+        if source:
+            # The worker won't say it ended, having exited or disconnected.
+            self.ended(
+                source, None if requested else "The voice connection was closed."
+            )
+
+    def is_connected(self):
+        return self.connected
+
+    def is_playing(self):
+        return self._source is not None and not self.paused
+
+    def is_paused(self):
+        return self._source is not None and self.paused
+
+    def open_source(self, location, kind, gain, volume, position=0):
+        return RemoteSource(self, location, kind, gain, volume, position)
+
+    def play(self, source, *, after=None):
+        if not self.connected:
+            raise discord.ClientException("Not connected to voice.")
+        if self._source is not None:
+            raise discord.ClientException("Already playing audio.")
+        self._source = source
+        self.paused = False
+        source.after = after
+        source.open()
+        self.worker.post(
+            op="play", guild=self.guild.id, source=source.id, measuring=source.measuring
+        )
+
+    def ended(self, source, error):
+        if self._source is source:
+            self._source = None
+            self.paused = False
+        # Only once, whether the worker or gone() ends it first.
+        after, source.after = source.after, None
+        if after:
+            after(error and Exception(error))
+
+    def stop(self):
+        if self._source is not None:
+            self.worker.post(op="stop", guild=self.guild.id)
+
+    def pause(self):
+        if self._source is not None:
+            self.paused = True
+            self.worker.post(op="pause", guild=self.guild.id)
+
+    def resume(self):
+        if self._source is not None:
+            self.paused = False
+            self.worker.post(op="resume", guild=self.guild.id)
+
+
+class RemoteSource:
+    """A song's audio, opened by the worker playing the guild's music.
+
+    Stands in for TrackedSource. The worker opens it once it is primed or
+    played, with the `ending_at` and `on_ending` set by then.
+    """
+
+    def __init__(self, voice, location, kind, gain, volume, position):
+        self.id = next(_ids)
+        self.worker = voice.worker
+        self.guild_id = voice.guild.id
+        self.location = location
+        self.kind = kind
+        self.gain = gain
+        self.volume = volume
+        self.start = position
+        self.ending_at = None
+        self.on_ending = None
+        self.measuring = None
+        self.after = None
+        self.opened = False
+
+    @property
+    def position(self):
+        # The volume is changed where the worker is at, see set_volume.
+        return self.start
+
+    def measure(self, name, since):
+        # perf_counter() is the same clock in every process.
+        self.measuring = (name, since)
+
+    def open(self):
+        if self.opened:
+            return
+        self.opened = True
+        self.worker.sources[self.id] = self
+        self.worker.post(
+            op="open",
+            source=self.id,
+            location=self.location,
+            kind=self.kind,
+            gain=self.gain,
+            volume=self.volume,
+            position=self.start,
+            ending_at=self.ending_at,
+        )
+
+    def prime(self):
+        self.worker.loop.call_soon_threadsafe(self._prime)
+
+    def _prime(self):
+        self.open()
+        self.worker.post(op="prime", source=self.id)
+
+    def set_volume(self, volume):
+        """Has the worker change the volume, reopening the audio itself if it
+        has to. Always returns True."""
+        self.volume = volume
+        self.worker.post(
+            op="volume", guild=self.guild_id, source=self.id, volume=volume
+        )
+        return True
+
+    def cleanup(self):
+        self.worker.loop.call_soon_threadsafe(self._close)
+
+    def _close(self):
+        if self.worker.sources.pop(self.id, None):
+            self.worker.post(op="close", source=self.id)
+
+
+class _ConnectionState:
+    """What discord.VoiceClient uses of discord.py's ConnectionState."""
+
+    def __init__(self, server, user_id):
+        self.server = server
+        self.loop = server.loop
+        self.user = types.SimpleNamespace(id=user_id)
+        self.http = server.http
+
+    def _remove_voice_client(self, guild_id):
+        self.server.voice_gone(guild_id)
+
+
+class _HTTPClient:
+    """Opens voice websockets like discord.py's HTTPClient."""
+
+    def __init__(self):
+        self.session = None
+
+    async def ws_connect(self, url, *, compress=0):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                ws_response_class=DiscordClientWebSocketResponse
+            )
+        return await self.session.ws_connect(
+            url,
+            max_msg_size=0,
+            timeout=30.0,
+            autoclose=False,
+            headers={"User-Agent": USER_AGENT},
+            compress=compress,
+        )
+
+
+class _Guild:
+    """A guild as far as its voice client needs one; the bot has the rest."""
+
+    def __init__(self, server, guild_id):
+        self.server = server
+        self.id = guild_id
+
+    def get_channel(self, channel_id):
+        return _Channel(self, channel_id)
+
+    async def change_voice_state(self, *, channel, self_mute=False, self_deaf=False):
+        self.server.send(
+            event="change_voice_state",
+            guild=self.id,
+            channel=channel.id if channel else None,
+        )
+
+
+class _Channel:
+    def __init__(self, guild, channel_id):
+        self.guild = guild
+        self.id = channel_id
+
+    def _get_voice_client_key(self):
+        return self.guild.id, "guild_id"
+
+
+class WorkerVoiceClient(discord.VoiceClient):
+    """discord.VoiceClient in a worker, joining and leaving through the bot."""
+
+    def __init__(self, server, guild_id, channel_id, user_id):
+        client = types.SimpleNamespace(
+            _connection=server.connection(user_id), loop=server.loop
+        )
+        super().__init__(client, _Guild(server, guild_id).get_channel(channel_id))
+
+
+class Server:
+    """The worker's side: connects and plays what the bot tells it to."""
+
+    def __init__(self, voice_class):
+        self.voice_class = voice_class
+        self.loop = asyncio.get_event_loop()
+        self.http = _HTTPClient()
+        self.connections = {}
+        # Voice clients by guild id, and sources by the bot's ids.
+        self.voices = {}
+        self.sources = {}
+        # Messages go out on the real stdout, anything printed goes to stderr.
+        self.output = os.fdopen(os.dup(1), "wb")
+        os.dup2(2, 1)
+        self.lock = threading.Lock()
+
+    def connection(self, user_id):
+        if user_id not in self.connections:
+            self.connections[user_id] = _ConnectionState(self, user_id)
+        return self.connections[user_id]
+
+    def send(self, **message):
+        """Sends a message to the bot. Can be called from any thread."""
+        line = json.dumps(message).encode() + b"\n"
+        with self.lock:
+            self.output.write(line)
+            self.output.flush()
+
+    async def serve(self):
+        # The bot's timings are recorded where they're reported.
+        waffle.metrics.on_record = lambda name, seconds: self.send(
+            event="timing", name=name, seconds=seconds
+        )
+        reader = asyncio.StreamReader()
+        await self.loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), sys.stdin
+        )
+        async for line in reader:
+            message = json.loads(line)
+            try:
+                result = getattr(self, "op_" + message.pop("op"))(**message)
+                if asyncio.iscoroutine(result):
+                    asyncio.ensure_future(result)
+            except Exception:
+                traceback.print_exc()
+        # The bot is gone.
+        for voice in list(self.voices.values()):
+            await voice.disconnect(force=True)
+
+    async def op_connect(self, guild, channel, user, timeout, reconnect):
+        voice = self.voices[guild] = self.voice_class(self, guild, channel, user)
+        try:
+            await voice.connect(timeout=timeout, reconnect=reconnect)
+        except Exception as error:
+            if self.voices.get(guild) is voice:
+                del self.voices[guild]
+            self.send(
+                event="connect_failed",
+                guild=guild,
+                timeout=isinstance(error, asyncio.TimeoutError),
+                error=str(error),
+            )
+            try:
+                await voice.disconnect(force=True)
+            except Exception:
+                pass
+        else:
+            self.send(event="connected", guild=guild)
+
+    async def op_voice_state_update(self, guild, data):
+        if guild in self.voices:
+            await self.voices[guild].on_voice_state_update(data)
+
+    async def op_voice_server_update(self, guild, data):
+        if guild in self.voices:
+            await self.voices[guild].on_voice_server_update(data)
+
+    async def op_disconnect(self, guild, force):
+        voice = self.voices.get(guild)
+        if voice:
+            await voice.disconnect(force=force)
+        # Answered even if it wasn't connected, and so wasn't cleaned up.
+        if self.voices.get(guild) is voice:
+            self.voices.pop(guild, None)
+            self.send(event="disconnected", guild=guild)
+
+    def voice_gone(self, guild):
+        if self.voices.pop(guild, None) is not None:
+            self.send(event="disconnected", guild=guild)
+
+    def op_open(self, source, location, kind, gain, volume, position, ending_at):
+        from waffle.music import open_source
+
+        audio = self.sources[source] = open_source(
+            location, kind, gain, volume, position
+        )
+        audio.ending_at = ending_at
+        audio.on_ending = lambda: self.send(event="ending", source=source)
+
+    def op_prime(self, source):
+        if source in self.sources:
+            self.loop.run_in_executor(None, self.sources[source].prime)
+
+    def op_close(self, source):
+        audio = self.sources.pop(source, None)
+        if audio:
+            self.loop.run_in_executor(None, audio.cleanup)
+
+    def op_play(self, guild, source, measuring):
+        def after(error):
+            self.sources.pop(source, None)
+            self.send(
+                event="ended", guild=guild, source=source, error=error and str(error)
+            )
+
+        voice = self.voices.get(guild)
+        audio = self.sources.get(source)
+        if not voice or not audio:
+            after("Not connected to voice.")
+            return
+        audio.measuring = measuring and tuple(measuring)
+        try:
+            voice.play(audio, after=after)
+        except discord.ClientException as error:
+            after(error)
+
+    def op_stop(self, guild):
+        if guild in self.voices:
+            self.voices[guild].stop()
+
+    def op_pause(self, guild):
+        if guild in self.voices:
+            self.voices[guild].pause()
+
+    def op_resume(self, guild):
+        if guild in self.voices:
+            self.voices[guild].resume()
+
+    def op_volume(self, guild, source, volume):
+        audio = self.sources.get(source)
+        voice = self.voices.get(guild)
+        if not audio or audio.set_volume(volume):
+            return
+        if not voice or voice.source is not audio:
+            # Not playing yet, so it's reopened at the new volume from the start.
+            self.op_close(source)
+            self.sources[source] = audio.reopen(volume)
+            return
+        # Like GuildMusicState.set_volume, from where the worker is.
+        self.sources[source] = voice.source = audio.reopen(volume)
+        self.loop.call_later(1, audio.cleanup)
+
+    def op_metrics(self, request):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        ffmpeg = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.send(
+            event="reply",
+            request=request,
+            counters=dict(waffle.metrics.counters),
+            cpu=usage.ru_utime + usage.ru_stime,
+            ffmpeg_cpu=ffmpeg.ru_utime + ffmpeg.ru_stime,
+            voices=len(self.voices),
+        )
+
+
+def serve(voice_class=WorkerVoiceClient):
+    """Runs a worker until the bot closes its stdin."""
+    asyncio.get_event_loop().run_until_complete(Server(voice_class).serve())
+
+
+if __name__ == "__main__":
+    serve()
@@ -1,8 +1,98 @@
+import json
+import asyncio
+import functools
+
 import sqlalchemy as sa
 from sqlalchemy.ext.asyncio import create_async_engine
 import waffle.config
 
 CONFIG = waffle.config.CONFIG["database"]
 
-engine = create_async_engine(CONFIG["uri"], connect_args={"check_same_thread": False})
+engine = create_async_engine(
+    CONFIG["uri"],
+    connect_args={"check_same_thread": False},
+    json_serializer=functools.partial(json.dumps, separators=(",", ":")),
+)
 metadata = sa.MetaData()
+
+
+@sa.event.listens_for(engine.sync_engine, "connect")
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Lets readers run alongside the writer and makes commits cheaper."""
+    if engine.dialect.name != "sqlite" or not CONFIG.get("wal", True):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    # In WAL mode NORMAL only syncs on checkpoints; a power cut can lose the
+    # last commits but never corrupts the database.
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA cache_size=-16000")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
+
+
+# Writes waiting for the next group commit, as (statement, parameters, future).
+_pending = []
+_flush = None
+# Group commits that haven't finished yet.
+_batches = set()
+
+
+async def write(statement, parameters=None):
+    """Executes a write as part of the next group commit and returns its result.
+
+    Writes from every caller that arrive within commit_delay milliseconds of
+    each other share one transaction, so a burst of writes costs one commit
+    instead of one each. The returned coroutine finishes once the
+    transaction holding the write has committed.
+    """
+    global _flush
+    future = asyncio.get_event_loop().create_future()
+    _pending.append((statement, parameters, future))
+    if _flush is None:
+        _flush = asyncio.ensure_future(_commit())
+        _batches.add(_flush)
+        _flush.add_done_callback(_batches.discard)
+    return await future
+
+
+async def flush():
+    """Waits until every write made so far has been committed (or failed)."""
+    if _batches:
+        await asyncio.wait(list(_batches))
+
+
+async def _execute(writes):
+    async with engine.begin() as conn:
+        return [
+            await conn.execute(statement, parameters)
+            for statement, parameters, _ in writes
+        ]
+
+
+async def _commit():
+    global _flush
+    await asyncio.sleep(CONFIG.get("commit_delay", 5) / 1000)
+    writes = _pending[:]
+    _pending.clear()
+    _flush = None
+
+    try:
+        results = await _execute(writes)
+    except Exception:
+        # One bad write (e.g. a duplicate key) shouldn't fail the others, so
+        # the batch is retried one write per transaction.
+        for write in writes:
+            try:
+                (result,) = await _execute([write])
+            except Exception as e:
+                if not write[2].done():
+                    write[2].set_exception(e)
+            else:
+                if not write[2].done():
+                    write[2].set_result(result)
+        return
+
+    for (_, _, future), result in zip(writes, results):
+        if not future.done():
+            future.set_result(result)
@@ -3,6 +3,7 @@ from discord.ext import commands
 
 import waffle.scheduler
 import waffle.database
+import waffle.metrics
 
 
 def setup(bot):
@@ -55,6 +56,13 @@ class Debug(commands.Cog):
         """Runs check_for_task"""
         await waffle.scheduler.check_for_tasks()
 
+    @commands.command()
+    @commands.is_owner()
+    async def stats(self, ctx):
+        """Shows the bot's counters and timings."""
+        lines = waffle.metrics.report() or ["Nothing recorded yet."]
+        await ctx.send("```\n{}\n```".format("\n".join(lines)))
+
     @commands.command()
     @commands.is_owner()
     async def clearcollection(self, ctx, database_name, collection_name):
@@ -0,0 +1,54 @@
+"""In-process counters and timings, shown by the stats command."""
+import threading
+from collections import Counter, defaultdict, deque
+
+# Audio sources and youtube_dl report from their own threads.
+_lock = threading.Lock()
+counters = Counter()
+# The most recent samples of each timing, in seconds.
+timings = defaultdict(lambda: deque(maxlen=1000))
+# Functions returning a current value, read when the report is made.
+gauges = {}
+# Called with every timing recorded, e.g. to pass it on to another process.
+on_record = None
+
+
+def increment(name, amount=1):
+    with _lock:
+        counters[name] += amount
+
+
+def record(name, seconds):
+    with _lock:
+        timings[name].append(seconds)
+    if on_record:
+        on_record(name, seconds)
+
+
+def gauge(name, function):
+    gauges[name] = function
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def report():
+    """Returns one line per counter, gauge and timing."""
+    with _lock:
+        lines = [f"{name:<32} {value}" for name, value in sorted(counters.items())]
+        lines += [f"{name:<32} {gauges[name]()}" for name in sorted(gauges)]
+        for name, samples in sorted(timings.items()):
+            lines.append(
+                "{:<32} p50 {:.0f}ms  p95 {:.0f}ms  max {:.0f}ms  (n={})".format(
+                    name,
+                    percentile(samples, 0.5) * 1000,
+                    percentile(samples, 0.95) * 1000,
+                    max(samples, default=0) * 1000,
+                    len(samples),
+                )
+            )
+    return lines
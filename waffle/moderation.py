@@ -1,8 +1,11 @@
 """Moderation commands."""
+import datetime
+
 import discord
 from discord.ext import commands
 import humanize
 
+import waffle
 import waffle.config
 import waffle.scheduler
 
@@ -12,6 +15,61 @@ CONFIG = waffle.config.CONFIG["config"]
 def setup(bot):
     """Set up the cog."""
     bot.add_cog(Moderation(bot))
+    waffle.scheduler.register("unmute", unmute_task)
+    waffle.scheduler.register("unban", unban_task)
+
+
+def teardown(bot):
+    """Stop handling moderation jobs."""
+    waffle.scheduler.unregister("unmute")
+    waffle.scheduler.unregister("unban")
+
+
+async def unmute_task(task):
+    """Unmutes a tempmuted user once the tempmute expires."""
+    guild = waffle.bot.get_guild(task["guild_id"])
+    if guild is None:
+        return
+    user = guild.get_member(task["user_id"])
+    muted = discord.utils.get(guild.roles, name=CONFIG["mute"])
+
+    if user is None:
+        user = waffle.bot.get_user(task["user_id"]) or discord.Object(task["user_id"])
+    elif muted in user.roles:
+        await user.remove_roles(muted, reason="Tempmute")
+    await _log_expiry(guild, task, "Unmute", user, "Tempmute")
+
+
+async def unban_task(task):
+    """Unbans a tempbanned user once the tempban expires."""
+    guild = waffle.bot.get_guild(task["guild_id"])
+    if guild is None:
+        return
+    user = waffle.bot.get_user(task["user_id"]) or discord.Object(task["user_id"])
+    try:
+        await guild.unban(user, reason="Tempban")
+    except discord.NotFound:
+        return
+    await _log_expiry(guild, task, "Unban", user, "Tempban")
+
+
+async def _log_expiry(guild, task, log_type, user, reason):
+    moderator = (
+        guild.get_member(task["moderator_id"])
+        or waffle.bot.get_user(task["moderator_id"])
+        or guild.me
+    )
+    if task["reason"]:
+        reason = f"{reason} ({task['reason']})"
+    await Moderation.send_mod_log(
+        guild,
+        moderator,
+        log_type,
+        user,
+        reason,
+        datetime.datetime.now(datetime.timezone.utc),
+        task["message_id"],
+    )
 
 
 class Moderation(commands.Cog):
@@ -29,11 +87,26 @@ class Moderation(commands.Cog):
     @staticmethod
     async def mod_log(ctx, log_type, user, reason, duration=None):
         """Mod logging."""
-        moderator = ctx.author
+        return await Moderation.send_mod_log(
+            ctx.guild,
+            ctx.author,
+            log_type,
+            user,
+            reason,
+            ctx.message.created_at,
+            ctx.message.id,
+            duration,
+        )
+
+    @staticmethod
+    async def send_mod_log(
+        guild, moderator, log_type, user, reason, timestamp, message_id, duration=None
+    ):
+        """Mod logging without a command context, e.g. for expired tasks."""
         embed = discord.Embed(
             title=f"{log_type} for user {user.id}",
             colour=discord.Colour(0xF8E71C),
-            timestamp=ctx.message.created_at,
+            timestamp=timestamp,
         )
         embed.set_author(
             name=moderator.name,
@@ -41,15 +114,15 @@ class Moderation(commands.Cog):
             icon_url=moderator.avatar_url,
         )
 
-        embed.add_field(name="User", value=user.mention, inline=True)
+        embed.add_field(name="User", value=f"<@{user.id}>", inline=True)
         embed.add_field(name="Moderator", value=moderator.mention, inline=True)
         embed.add_field(name="Reason", value=reason, inline=True)
         if duration:
             embed.add_field(
                 name="Duration:", value=humanize.naturaldelta(duration), inline=True
             )
-        embed.set_footer(text=f"ID: {ctx.message.id}")
-        log_channel = discord.utils.get(ctx.guild.channels, name=CONFIG["log_channel"])
+        embed.set_footer(text=f"ID: {message_id}")
+        log_channel = discord.utils.get(guild.channels, name=CONFIG["log_channel"])
         if log_channel:
             await log_channel.send(embed=embed)
 
@@ -132,7 +205,7 @@ class Moderation(commands.Cog):
     @commands.has_permissions(ban_members=True)
     async def tempban(self, ctx, user: discord.Member, duration, *, reason):
         await ctx.invoke(self.ban, user=user, reason=reason)
-        waffle.scheduler.set_task(ctx, "unban", duration, user.id)
+        await waffle.scheduler.set_task(ctx, "unban", duration, user.id, reason)
 
     @commands.command(name="addrole")
     @commands.guild_only()
@@ -215,4 +288,4 @@ class Moderation(commands.Cog):
     @commands.guild_only()
     async def tempmute(self, ctx, user: discord.Member, duration, *, reason):
         await ctx.invoke(self.mute, user=user, reason=reason)
-        await waffle.scheduler.set_task(ctx, "unmute", duration, user.id)
+        await waffle.scheduler.set_task(ctx, "unmute", duration, user.id, reason)
@@ -1,78 +1,500 @@
 """Music commands."""
-import asyncio
-from pathlib import Path, PurePath
 import os
-from datetime import timedelta
-from collections import deque
+import re
+import sys
+import time
+import asyncio
+import threading
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 
 import discord
 from discord.ext import commands
 import youtube_dl
+from youtube_dl.postprocessor.ffmpeg import FFmpegPostProcessor
 import waffle.config
+import waffle.metrics
+import waffle.reaction
+import waffle.audio_worker
+import waffle.audio_cache
+import waffle.scheduler
+import waffle.song_cache
+import waffle.song_index
+import waffle.queue_store
+from waffle.single_flight import SingleFlight
+from waffle.song_queue import SongQueue
 
 CONFIG = waffle.config.CONFIG["config"]
 
+# youtube_dl blocks while it searches, downloads and transcodes, so it runs on
+# these threads instead of the event loop.
+executor = ThreadPoolExecutor(
+    max_workers=CONFIG.get("music_workers", 4), thread_name_prefix="music"
+)
+# Songs that aren't cached yet are played straight from youtube while the cache
+# copy downloads, instead of only once the download and transcode finished.
+STREAM = CONFIG.get("stream", True)
+STREAM_OPTIONS = "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5"
+# Queued songs downloaded ahead of time, so they play from the cache.
+PREFETCH = CONFIG.get("prefetch", 2)
+# Volume of guilds that haven't changed it. Songs are cached at this volume, so
+# with opus passthrough they are sent as they are instead of being decoded,
+# scaled and encoded again for every frame.
+DEFAULT_VOLUME = 0.1
+OPUS_PASSTHROUGH = CONFIG.get("opus_passthrough", True)
+# YouTube links to a playlist (or to a video within one).
+PLAYLIST = re.compile(r"^https?://(www\.|music\.)?youtube\.com/\S*[?&]list=")
+# Seconds before a song ends that the next one is opened, so it can start
+# right away instead of waiting for ffmpeg (and youtube) to get going.
+PRELOAD = CONFIG.get("preload", 5)
+# Songs per page of the queue command.
+QUEUE_PAGE_SIZE = 10
+MODE_EMOJIS = {None: ":play_pause:", "loop": ":repeat:", "repeat": ":repeat_one:"}
+# Seconds a guild's music state is kept after its last command once nothing is
+# playing or queued. It's made again, empty, by the next command.
+IDLE_TIMEOUT = CONFIG.get("music_idle_timeout", 600)
+
 
 def setup(bot):
     """Sets up the cog."""
     bot.add_cog(Music(bot))
+    waffle.audio_cache.scan(f"opus gain={DEFAULT_VOLUME}")
+    asyncio.ensure_future(waffle.song_index.load())
+    waffle.scheduler.register("purge_song_cache", waffle.song_cache.purge_expired)
+    asyncio.ensure_future(
+        waffle.scheduler.schedule(
+            "purge_song_cache",
+            datetime.now(),
+            interval=86400,
+            key="purge_song_cache",
+        )
+    )
 
 
-class Song:
-    """A song object to play youtube videos from."""
+def teardown(bot):
+    """Stop handling music jobs."""
+    waffle.scheduler.unregister("purge_song_cache")
+    waffle.audio_worker.shutdown()
 
-    def __init__(self):
-        self.opts = {
-            "format": "bestaudio/best",
-            "postprocessors": [
-                {
-                    "key": "FFmpegExtractAudio",
-                    "preferredcodec": "opus",
-                    "preferredquality": "192",
-                }
+
+class DownloadCancelled(Exception):
+    """Raised inside youtube_dl to abort the download of a cancelled song."""
+
+
+class ApplyGain(FFmpegPostProcessor):
+    """Re-encodes a downloaded song at DEFAULT_VOLUME into the cache.
+
+    Songs are downloaded and converted in cache/downloads, and the cache copy
+    is written next to its final name and renamed into place, so a song in the
+    cache is always complete.
+    """
+
+    def run(self, information):
+        path = information["filepath"]
+        target = str(waffle.audio_cache.path(information["id"]))
+        self.run_ffmpeg(
+            path,
+            target + ".part",
+            [
+                "-filter:a",
+                f"volume={DEFAULT_VOLUME}",
+                "-c:a",
+                "libopus",
+                "-b:a",
+                "128k",
+                "-f",
+                "opus",
             ],
-            "outtmpl": "cache/%(id)s.%(ext)s",
-            "quiet": True,
-        }
-        self.youtube = youtube_dl.YoutubeDL(self.opts)
+        )
+        os.replace(target + ".part", target)
+        os.remove(path)
+        information["filepath"] = target
+        return [], information
 
-    def create(self, ctx, query):
-        try:
-            extracted_info = self.from_youtube(query)
-            self.video_id = extracted_info.get("id", None)
-            self.url = extracted_info.get("webpage_url", None)
-            self.title = extracted_info.get("title", None)
-            self.duration_seconds = extracted_info.get("duration", None)
-            self.duration = str(timedelta(seconds=self.duration_seconds))
-            self.filename = PurePath("cache/", self.video_id + ".opus")
-            self.thumbnail = (
-                f"https://img.youtube.com/vi/{self.video_id}/" "maxresdefault.jpg"
+
+class Extractors(threading.local):
+    """The YoutubeDL instances of a music thread.
+
+    Setting up a YoutubeDL takes tens of milliseconds and it isn't safe to use
+    from several threads at once, so each executor thread makes its own once
+    and every song resolved on that thread reuses it.
+    """
+
+    def __init__(self):
+        # The job being run, checked by the progress hook.
+        self.job = None
+        self.youtube = None
+        self.flat = None
+
+    def get(self, job):
+        """Returns the YoutubeDL to run `job` with."""
+        if self.youtube is None:
+            self.youtube = self.create()
+        self.job = job
+        return self.youtube
+
+    def get_flat(self):
+        """Returns the YoutubeDL listing playlists without looking up videos."""
+        if self.flat is None:
+            self.flat = youtube_dl.YoutubeDL(
+                {"extract_flat": "in_playlist", "quiet": True}
             )
-            self.uploader = extracted_info.get("uploader", None)
-            self.channel_url = extracted_info.get("channel_url", None)
-            self.artist = extracted_info.get("artist", None)
-            self.position = len(ctx.music_state.queue) + 1
-            self.requested_by = ctx.author
-            if not Path(self.filename).exists():
-                try:
-                    return self.youtube.extract_info(self.url, download=True)
-                except youtube_dl.utils.DownloadError:
-                    return None
+        return self.flat
+
+    def create(self):
+        youtube = youtube_dl.YoutubeDL(
+            {
+                "format": "bestaudio/best",
+                "postprocessors": [
+                    {
+                        "key": "FFmpegExtractAudio",
+                        "preferredcodec": "opus",
+                        "preferredquality": "192",
+                    }
+                ],
+                "outtmpl": f"{waffle.audio_cache.DOWNLOADS}/%(id)s.%(ext)s",
+                "quiet": True,
+                "progress_hooks": [self.check_cancelled],
+            }
+        )
+        youtube.add_post_processor(ApplyGain(youtube))
+        return youtube
+
+    def check_cancelled(self, status):
+        """Progress hook that stops the download once its job is cancelled."""
+        if self.job is not None and self.job.cancelled:
+            raise DownloadCancelled()
+
+
+extractors = Extractors()
+
+
+class TrackedSource(discord.AudioSource):
+    """A song's audio, keeping count of how far it has been played.
+
+    Once the song is `ending_at` seconds in, `on_ending` is called from the
+    player's thread. If a timing is being measured, the time until the first
+    audio is recorded under its name.
+    """
+
+    def __init__(self, original, kind, gain, start=0, location=None):
+        self.original = original
+        self.location = location
+        self.kind = kind
+        self.gain = gain
+        self.start = start
+        self.frames = 0
+        self.ending_at = None
+        self.on_ending = None
+        self.measuring = None
+        # The first frame, read ahead of time by prime().
+        self.buffered = None
+        self.closed = False
+        self.lock = threading.Lock()
+
+    @property
+    def position(self):
+        """Seconds into the song."""
+        return self.start + self.frames * discord.opus.Encoder.FRAME_LENGTH / 1000
+
+    def measure(self, name, since):
+        """Records the time from `since` (a time.perf_counter() value) to the
+        first audio."""
+        self.measuring = (name, since)
+
+    def prime(self):
+        """Waits for the first frame, so it's ready once the song plays."""
+        with self.lock:
+            if not self.closed and self.frames == 0 and self.buffered is None:
+                self.buffered = self.original.read()
+
+    def read(self):
+        with self.lock:
+            if self.buffered is not None:
+                data, self.buffered = self.buffered, None
             else:
-                return self.youtube.extract_info(self.url, download=False)
-        except youtube_dl.utils.DownloadError:
-            return None
+                data = self.original.read()
+        if not data:
+            return data
+        self.frames += 1
+        if self.measuring:
+            name, since = self.measuring
+            waffle.metrics.record(name, time.perf_counter() - since)
+            self.measuring = None
+        if self.ending_at is not None and self.position >= self.ending_at:
+            self.ending_at = None
+            self.on_ending()
+        return data
+
+    def is_opus(self):
+        return self.original.is_opus()
+
+    def set_volume(self, volume):
+        """Changes the volume (relative to the gain) if it can be changed in
+        place, which is when the audio is scaled in Python. Returns whether it
+        could."""
+        if isinstance(self.original, discord.PCMVolumeTransformer):
+            self.original.volume = volume
+            return True
+        return False
+
+    def reopen(self, volume):
+        """Opens the same audio again at another volume, from where this is."""
+        source = open_source(self.location, self.kind, self.gain, volume, self.position)
+        source.ending_at, source.on_ending = self.ending_at, self.on_ending
+        return source
+
+    def cleanup(self):
+        # Waits for prime() or read() to finish with the ffmpeg process.
+        with self.lock:
+            self.closed = True
+            self.original.cleanup()
+
+
+def open_source(location, kind, gain, volume, position=0):
+    """Opens audio with ffmpeg, `position` seconds in.
+
+    `volume` is relative to the `gain` the audio was stored at.
+    """
+    before = f"-ss {position}" if position else ""
+    if kind == "stream":
+        before += " " + STREAM_OPTIONS
+    if not OPUS_PASSTHROUGH:
+        source = discord.PCMVolumeTransformer(
+            discord.FFmpegPCMAudio(location, before_options=before, options="-vn"),
+            volume=volume,
+        )
+    elif volume == 1:
+        source = discord.FFmpegOpusAudio(
+            location, codec="opus", before_options=before, options="-loglevel error"
+        )
+    else:
+        # ffmpeg scales and encodes in one process, which still beats
+        # piping PCM through Python.
+        source = discord.FFmpegOpusAudio(
+            location,
+            before_options=before,
+            options=f"-vn -filter:a volume={volume:.4f}",
+        )
+    return TrackedSource(source, kind, gain, position, location)
+
+
+def extract_playlist(url):
+    """Lists a playlist's videos (id and title) without looking each one up."""
+    try:
+        info = extractors.get_flat().extract_info(url, download=False)
+    except youtube_dl.utils.DownloadError:
+        return []
+    return [entry for entry in info.get("entries") or [] if entry.get("id")]
+
+
+class Job:
+    """A youtube_dl call, which stops at its next progress report once cancelled."""
+
+    __slots__ = ("cancelled",)
+
+    def __init__(self):
+        self.cancelled = False
+
+
+async def run_youtube_dl(function, *args):
+    """Runs `function(job, *args)` on the music threads.
+
+    When cancelled, the call is told to stop and waited for, so nothing else
+    writes the same files while it winds down.
+    """
+    job = Job()
+    future = asyncio.get_event_loop().run_in_executor(executor, function, job, *args)
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        job.cancelled = True
+        await asyncio.wait([future])
+        raise
+
 
-    def from_youtube(self, request):
-        """Gets video info."""
+def find(job, query):
+    """Returns the info of a URL's video or of a search's first result."""
+    youtube = extractors.get(job)
+    try:
+        if re.match("https?://", query):
+            return youtube.extract_info(query, download=False)
+        info = youtube.extract_info("ytsearch:" + query, download=False)
+    except youtube_dl.utils.DownloadError:
+        return None
+    entries = info.get("entries") or [None]
+    return entries[0]
 
-        query = "ytsearch:" + str(request)
-        info = self.youtube.extract_info(query, download=False)
-        entries = info.get("entries", None)
-        extracted_info = entries[0]
-        return extracted_info
 
-    def embed(self, author, action):
+def download_song(job, url):
+    try:
+        extractors.get(job).extract_info(url, download=True)
+    except (youtube_dl.utils.DownloadError, DownloadCancelled):
+        return False
+    return True
+
+
+# Searches and downloads that are underway, shared by every guild asking for
+# the same song meanwhile. Each one joined is a youtube_dl call avoided.
+searching = SingleFlight("extractions_avoided_search")
+downloading = SingleFlight("extractions_avoided_download")
+
+
+async def search(query):
+    """Looks up a search or URL, caching what it found. Returns its info."""
+    return await searching.run(waffle.song_cache.normalize(query), _search, query)
+
+
+async def _search(query):
+    info = await run_youtube_dl(find, query)
+    if info:
+        await waffle.song_cache.store(query, info)
+    return info
+
+
+async def download(info):
+    """Downloads a song into the cache. Returns whether it worked."""
+    return await downloading.run(info["id"], _download, info)
+
+
+async def _download(info):
+    if not await run_youtube_dl(download_song, info["webpage_url"]):
+        return False
+    waffle.audio_cache.add(info["id"])
+    waffle.song_index.add(info)
+    return True
+
+
+class Song:
+    """A song object to play youtube videos from.
+
+    Songs start out as placeholders holding only what was asked for (and the
+    id and title, for playlist entries), and are resolved into the full song
+    when they are about to be played. Whole playlists end up queued, so songs
+    only keep what they show or play with: everything else is derived from
+    the video id, and the requester is kept as an id rather than a Member.
+    """
+
+    __slots__ = (
+        "_query",
+        "_url",
+        "requester_id",
+        "video_id",
+        "title",
+        "duration_seconds",
+        "uploader",
+        "artist",
+        "resolved",
+        "resolution",
+        "stream_url",
+        "downloaded",
+    )
+
+    def __init__(self, query, requester_id, video_id=None, title=None):
+        self.video_id = video_id
+        self.title = title or query
+        self._url = None
+        # Playlist entries are queued by their URL, which is the video's.
+        self._query = None if video_id and query == self.url else query
+        self.requester_id = requester_id
+        self.duration_seconds = None
+        self.uploader = None
+        self.artist = None
+        self.resolved = False
+        # Resolves the placeholder, see GuildMusicState.resolve_placeholder.
+        self.resolution = None
+        self.stream_url = None
+        self.downloaded = False
+
+    @property
+    def query(self):
+        return self._query or self.url
+
+    @property
+    def url(self):
+        if self._url:
+            return self._url
+        if self.video_id:
+            return f"https://www.youtube.com/watch?v={self.video_id}"
+        return None
+
+    @property
+    def duration(self):
+        if self.duration_seconds is None:
+            return "?"
+        return str(timedelta(seconds=self.duration_seconds))
+
+    @property
+    def thumbnail(self):
+        if not self.resolved:
+            return discord.Embed.Empty
+        return f"https://img.youtube.com/vi/{self.video_id}/maxresdefault.jpg"
+
+    @property
+    def filename(self):
+        return waffle.audio_cache.path(self.video_id)
+
+    @property
+    def requester_mention(self):
+        return f"<@{self.requester_id}>"
+
+    def load(self, extracted_info):
+        """Fills in the song from youtube_dl's (or the song cache's) info."""
+        self.video_id = extracted_info.get("id", None)
+        self._url = None
+        url = extracted_info.get("webpage_url", None)
+        if url != self.url:
+            self._url = url
+        self.title = extracted_info.get("title", None)
+        self.duration_seconds = extracted_info.get("duration", None)
+        self.uploader = extracted_info.get("uploader", None)
+        self.artist = extracted_info.get("artist", None)
+        self.resolved = True
+
+    def metadata(self):
+        """Returns what load() needs to fill in the song again."""
+        return {
+            "id": self.video_id,
+            "webpage_url": self.url,
+            "title": self.title,
+            "duration": self.duration_seconds,
+            "uploader": self.uploader,
+            "artist": self.artist,
+        }
+
+    def dump(self):
+        """Returns the song as JSON, for restore() to queue it again."""
+        saved = {
+            "query": self.query,
+            "requester_id": self.requester_id,
+            "video_id": self.video_id,
+            "title": self.title,
+        }
+        if self.resolved:
+            saved["info"] = self.metadata()
+        return saved
+
+    @classmethod
+    def restore(cls, saved):
+        """Makes a song saved by dump() again.
+
+        It's only resolved if it's still cached, otherwise it's resolved again
+        when it's about to be played, from the song cache if it can be.
+        """
+        info = saved.get("info")
+        if info and waffle.audio_cache.cached(info["id"]):
+            song = cls(saved["query"], saved["requester_id"])
+            song.load(info)
+            return song
+        return cls(
+            saved["query"],
+            saved["requester_id"],
+            video_id=saved["video_id"],
+            title=saved["title"],
+        )
+
+    def embed(self, author, action, position):
         embed = discord.Embed(
             title=self.title, url=self.url, colour=discord.Colour(0xFF0000)
         )
@@ -80,7 +502,7 @@ class Song:
         embed.set_author(name=f"{author.name} {action}", icon_url=author.avatar_url)
         embed.add_field(name="Uploader", value=self.uploader, inline=True)
         embed.add_field(name="Artist", value=self.artist, inline=True)
-        embed.add_field(name="Position in queue", value=self.position, inline=True)
+        embed.add_field(name="Position in queue", value=position, inline=True)
         embed.add_field(name="Duration:", value=self.duration, inline=True)
         return embed
 
@@ -90,17 +512,112 @@ class GuildMusicState:
 
     def __init__(self, ctx, loop):
         self.bot = ctx.bot
-        self.ctx = ctx
-        self.queue = deque()
+        # Only the guild and the channel music messages go to are kept, so the
+        # state doesn't hold on to the message and member of the first command.
+        self.guild = ctx.guild
+        self.channel = ctx.channel
+        self.queue = SongQueue()
         self.queue_capacity = CONFIG["queue_capacity"]
         self.voice = ctx.guild.voice_client
-        self.volume = 0.1
+        self.volume = DEFAULT_VOLUME
         self.current_song = None
         self.loop = loop
         self.mode = None
+        # Songs are resolved one at a time per guild, so one guild queueing a
+        # lot can't take every executor thread from the others.
+        self.resolve_lock = asyncio.Semaphore(1)
+        self.resolving = set()
+        # Cache downloads of the current and upcoming songs, by song.
+        self.downloads = {}
+        # The next song, its source and the volume it was opened at.
+        self.preloaded = None
+        # Rendered pages of the queue command, valid while `pages_key` is.
+        self.pages = {}
+        self.pages_key = None
+        # Evicts the state once it has been idle for IDLE_TIMEOUT.
+        self.idle_timer = None
+        # Whether changes to the queue are saved, see waffle.queue_store.
+        self.saving = True
+        self.queue.on_change = self.save
+
+    async def send(self, *args, **kwargs):
+        return await self.channel.send(*args, **kwargs)
+
+    def save(self, op, *args):
+        """Records a change to the queue, the current song, mode or volume."""
+        if self.saving:
+            args = [arg.dump() if isinstance(arg, Song) else arg for arg in args]
+            waffle.queue_store.record(self.guild.id, [op, *args], self.dump)
+
+    def dump(self):
+        """Returns everything waffle.queue_store saves of the guild's music."""
+        return {
+            "mode": self.mode,
+            "volume": self.volume,
+            "current": self.current_song.dump() if self.current_song else None,
+            "songs": [song.dump() for song in self.queue],
+        }
+
+    def restore(self, saved):
+        """Queues the songs of a queue saved before a restart.
+
+        The song that was playing is queued first, and the saved queue is
+        rewritten to match.
+        """
+        self.saving = False
+        self.mode = saved["mode"]
+        if saved["volume"] is not None:
+            self.volume = saved["volume"]
+        songs = saved["songs"]
+        current = saved["current"]
+        if current:
+            last = songs[-1] if songs else None
+            if self.mode == "loop" and last and last["query"] == current["query"]:
+                # Loop mode had put it back at the end already.
+                songs = songs[:-1]
+            songs = [current, *songs]
+        for saved_song in songs:
+            song = Song.restore(saved_song)
+            if song.resolved:
+                waffle.audio_cache.pin(song.video_id)
+            self.queue.append(song)
+        self.saving = True
+        waffle.queue_store.save(self.guild.id, self.dump())
+
+    def unload(self):
+        """Stops playing without touching the saved queue, which the reloaded
+        cog restores."""
+        self.saving = False
+        if self.idle_timer:
+            self.idle_timer.cancel()
+        for task in self.resolving:
+            task.cancel()
+        self.discard_preloaded()
+        voice, self.voice = self.voice, None
+        if voice:
+            asyncio.ensure_future(voice.disconnect(force=True))
+
+    def set_current_song(self, song):
+        self.current_song = song
+        self.save("current", song)
+
+    def set_mode(self, mode):
+        self.mode = mode
+        self.save("mode", mode)
+
+    def is_idle(self):
+        """Returns whether the state can be dropped without anyone noticing."""
+        connected = self.voice is not None and self.voice.is_connected()
+        return not (
+            connected
+            or self.current_song
+            or self.queue
+            or self.resolving
+            or self.downloads
+        )
 
     def next_song_info(self):
-        if self.mode == "repeat":
+        if self.mode == "repeat" and self.current_song:
             return self.current_song
         elif self.mode == "loop":
             song = self.queue.popleft()
@@ -111,42 +628,337 @@ class GuildMusicState:
         elif not self.queue:
             return None
 
-    async def play_next_song(self, song):
-        """Plays next song."""
+    def peek_next_song(self):
+        """Returns the song next_song_info() would, without taking it."""
+        if self.mode == "repeat" and self.current_song:
+            return self.current_song
+        return self.queue[0] if self.queue else None
+
+    async def play_next_song(self, song, requested_at=None, ended_at=None):
+        """Plays next song.
+
+        If requested_at (a time.perf_counter() value) is given, the time until
+        the song's first audio is recorded. If ended_at is given instead, the
+        time since the previous song ended is.
+        """
+        previous = self.current_song
+        if previous and previous is not song and previous.resolved:
+            waffle.audio_cache.unpin(previous.video_id)
+        self.set_current_song(song)
+        while song and not song.resolved:
+            # A placeholder that wasn't resolved in time (or can't be).
+            found = await self.resolve_placeholder(song)
+            if not self.voice:
+                # Stopped while the song was being resolved.
+                return
+            if found:
+                break
+            await self.send(
+                f":no_entry_sign: Couldn't find `{song.query}`, skipping it."
+            )
+            if song in self.queue:
+                # Put back by loop mode.
+                self.queue.remove(song)
+            song = self.next_song_info()
+            self.set_current_song(song)
         if not song:
             self.current_song = None
+            self.discard_preloaded()
             await asyncio.sleep(10)
             if not self.voice.is_playing() and not self.voice.is_paused():
                 await self.voice.disconnect()
-                await self.ctx.send("Disconnected due to timeout.")
+                await self.send("Disconnected due to timeout.")
                 self.cleanup()
             return
 
-        for index, item in enumerate(self.queue):
-            item.position = index + 1
+        self.prefetch()
+        source = self.take_preloaded(song) or self.source(song)
+        if requested_at is not None:
+            source.measure(f"time_to_first_audio_{source.kind}", requested_at)
+        elif ended_at is not None:
+            source.measure("track_gap", ended_at)
+        self.voice.play(source, after=self.song_ended)
 
-        self.current_song = song
-        self.voice.play(
-            discord.PCMVolumeTransformer(
-                discord.FFmpegPCMAudio(song.filename), volume=self.volume
-            ),
-            after=lambda e: self.loop.create_task(
-                self.play_next_song(self.next_song_info())
-            ),
-        )
+    def song_ended(self, error):
+        """Called from the player's thread once a song stops."""
+        if error:
+            print(f"Player error: {error}", file=sys.stderr)
+        ended_at = time.perf_counter()
+
+        def play_next():
+            if not self.voice:
+                # Stopped, or the cog was unloaded.
+                return
+            if not self.voice.is_connected():
+                # The connection was lost, e.g. with the audio worker playing
+                # it. The song starts over once play or resume reconnects.
+                self.interrupted()
+                return
+            self.loop.create_task(
+                self.play_next_song(self.next_song_info(), ended_at=ended_at)
+            )
+
+        self.loop.call_soon_threadsafe(play_next)
+
+    def interrupted(self):
+        """Queues the song that was playing first again, and forgets the
+        voice connection that was lost under it."""
+        self.voice = None
+        self.discard_preloaded()
+        song = self.current_song
+        if not song:
+            return
+        if song in self.queue:
+            # Put back by loop mode, and pinned a second time with it.
+            self.queue.remove(song)
+            if song.resolved:
+                waffle.audio_cache.unpin(song.video_id)
+        self.queue.appendleft(song)
+        self.set_current_song(None)
+
+    def preload(self):
+        """Opens the next song and waits for its first frame in the background."""
+        song = self.peek_next_song()
+        if not song or not song.resolved:
+            return
+        if self.preloaded and self.preloaded[0] is song:
+            return
+        self.discard_preloaded()
+        source = self.source(song)
+        self.preloaded = (song, self.volume, source)
+        self.loop.run_in_executor(None, source.prime)
+
+    def take_preloaded(self, song):
+        """Returns the preloaded source if it's of `song` and still usable."""
+        if self.preloaded:
+            preloaded, volume, source = self.preloaded
+            if preloaded is song and volume == self.volume:
+                self.preloaded = None
+                return source
+            self.discard_preloaded()
+        return None
+
+    def discard_preloaded(self):
+        if self.preloaded:
+            # Might still be waiting for its first frame.
+            self.loop.run_in_executor(None, self.preloaded[2].cleanup)
+            self.preloaded = None
+
+    def source(self, song, position=0):
+        """Opens a song's audio at the guild's volume, `position` seconds in."""
+        # The cache copy of a streamed song is only used once it is complete.
+        if song.stream_url and not song.downloaded:
+            location, kind, gain = song.stream_url, "stream", 1
+        else:
+            location, kind, gain = str(song.filename), "cache", DEFAULT_VOLUME
+        volume = self.volume / gain
+        if isinstance(self.voice, waffle.audio_worker.RemoteVoiceClient):
+            # Opened by the worker process playing the guild's music.
+            source = self.voice.open_source(location, kind, gain, volume, position)
+        else:
+            source = open_source(location, kind, gain, volume, position)
+        if PRELOAD and song.duration_seconds:
+            source.ending_at = song.duration_seconds - PRELOAD
+            source.on_ending = lambda: self.loop.call_soon_threadsafe(self.preload)
+        return source
+
+    def set_volume(self, volume):
+        """Changes the volume, including that of the song being played."""
+        self.volume = volume
+        self.save("volume", volume)
+        self.discard_preloaded()
+        source = self.voice.source if self.voice else None
+        if not isinstance(source, (TrackedSource, waffle.audio_worker.RemoteSource)):
+            return
+        if source.set_volume(volume / source.gain):
+            return
+        # Opus is sent as it is, so the song is reopened at the new volume
+        # where it was. The player may still be reading the old source for a
+        # moment, so its ffmpeg process is stopped a bit later.
+        self.voice.source = self.source(self.current_song, source.position)
+        self.loop.call_later(1, source.cleanup)
+
+    async def resolve(self, song):
+        """Resolves and downloads a song off the event loop.
+
+        Songs whose search and file are both cached never touch youtube_dl,
+        and neither do new searches clearly matching a cached song. Songs that
+        aren't cached are downloaded, or when streaming only have their media
+        URL looked up.
+        """
+        info = await waffle.song_cache.lookup(song.query)
+        if not info and song.video_id:
+            info = await waffle.song_cache.lookup_video(song.video_id)
+        if not info and not song.video_id:
+            info = waffle.song_index.match(song.query)
+        if info and waffle.audio_cache.lookup(info["id"]):
+            song.load(info)
+            return song
+
+        async with self.resolve_lock:
+            if not info:
+                info = await search(song.query)
+                if not info:
+                    return None
+            # The song is only loaded once it can be played, since preload()
+            # opens the next song as soon as it's resolved.
+            if waffle.audio_cache.lookup(info["id"]):
+                song.load(info)
+                return song
+            if not STREAM:
+                if not await download(info):
+                    return None
+                song.load(info)
+                song.downloaded = True
+                return song
+            # Search results come with the URL of the chosen format. Cached
+            # info doesn't, because media URLs expire after a few hours.
+            if "url" not in info:
+                info = await search(info["webpage_url"])
+                if not info:
+                    return None
+            song.load(info)
+            song.stream_url = info["url"]
+        return song
+
+    async def resolve_placeholder(self, song):
+        """Resolves a queued song, returning whether it worked.
+
+        Resolution starts once, however often it's awaited, and carries on
+        even if whatever awaited it is cancelled.
+        """
+        if song.resolution is None:
+            song.resolution = asyncio.ensure_future(self.resolve(song))
+            self.resolving.add(song.resolution)
+            song.resolution.add_done_callback(self.placeholder_resolved(song))
+        try:
+            return bool(await asyncio.shield(song.resolution))
+        except asyncio.CancelledError:
+            if song.resolution.cancelled():
+                return False
+            raise
+
+    def placeholder_resolved(self, song):
+        def callback(task):
+            self.resolving.discard(task)
+            # Its title and link may be shown on a page.
+            self.pages.clear()
+            queued = song is self.current_song or song in self.queue
+            if song.resolved and queued:
+                waffle.audio_cache.pin(song.video_id)
+                self.prefetch()
+
+        return callback
+
+    def prefetch(self):
+        """Downloads the current song and the next few while they are streamed.
+
+        Downloads of songs that were removed or moved further back are
+        cancelled. Placeholders among them are resolved first.
+        """
+        # In playing order, since each guild resolves one song at a time.
+        upcoming = [self.current_song, *itertools.islice(self.queue, PREFETCH)]
+        for song in self.downloads:
+            if song not in upcoming:
+                self.downloads[song].cancel()
+        for song in upcoming:
+            if song and not song.resolved and song.resolution is None:
+                asyncio.ensure_future(self.resolve_placeholder(song))
+            if not song or not song.stream_url or song.downloaded:
+                continue
+            if song not in self.downloads:
+                self.downloads[song] = asyncio.ensure_future(self.cache_song(song))
+
+    async def cache_song(self, song):
+        try:
+            if await download(song.metadata()):
+                song.downloaded = True
+        except asyncio.CancelledError:
+            # Might have moved back up while it was being cancelled.
+            self.loop.call_soon(self.prefetch)
+            raise
+        finally:
+            del self.downloads[song]
 
     def cleanup(self):
-        self.mode = None
+        for task in self.resolving:
+            task.cancel()
+        for song in (self.current_song, *self.queue):
+            if song and song.resolved:
+                waffle.audio_cache.unpin(song.video_id)
+        self.set_mode(None)
         self.queue.clear()
-        self.current_song = None
+        self.set_current_song(None)
         self.voice = None
+        self.prefetch()
+        self.discard_preloaded()
 
     def add_to_queue(self, song):
-        if self.current_song:
-            song.position = len(self.queue) + 1
-        else:
-            song.position = "Now playing"
+        if song.resolved:
+            waffle.audio_cache.pin(song.video_id)
         self.queue.append(song)
+        self.prefetch()
+
+    def position(self, song):
+        """Returns where a song is in the queue, counting from 1."""
+        if song in self.queue:
+            return self.queue.index(song) + 1
+        return "Now playing" if song is self.current_song else None
+
+    def queue_page_count(self):
+        return max(1, -(-len(self.queue) // QUEUE_PAGE_SIZE))
+
+    def queue_page(self, page):
+        """Returns the embed of a page of the queue, counting from 0.
+
+        Pages are rendered when first shown and kept until the queue, the
+        current song or the mode changes.
+        """
+        key = (self.queue.version, self.current_song, self.mode)
+        if key != self.pages_key:
+            self.pages = {}
+            self.pages_key = key
+        if page not in self.pages:
+            self.pages[page] = self.render_queue_page(page)
+        return self.pages[page]
+
+    def render_queue_page(self, page):
+        song = self.current_song
+        if song:
+            playing = (
+                f"{song_link(song)} "
+                f"| {song.duration} Requested by "
+                f"{song.requester_mention}"
+            )
+        else:
+            playing = "Nothing"
+        embed = discord.Embed(
+            title=f"Queue for {self.guild}",
+            colour=discord.Colour(0xF8E71C),
+            description=f"{MODE_EMOJIS[self.mode]} Now Playing:\n "
+            f"{playing}\n\n\n"
+            f":arrow_down: Up next :arrow_down:",
+        )
+        start = page * QUEUE_PAGE_SIZE
+        songs = itertools.islice(self.queue.iterate(start), QUEUE_PAGE_SIZE)
+        for position, song in enumerate(songs, start + 1):
+            embed.add_field(
+                name=f"{position}.",
+                value=f"{song_link(song)} "
+                f"| {song.duration} "
+                f"Requested by {song.requester_mention}",
+                inline=False,
+            )
+        embed.set_footer(
+            text=f"Page {page + 1}/{self.queue_page_count()} "
+            f"| {len(self.queue)} songs queued"
+        )
+        return embed
+
+
+def song_link(song):
+    # Searches that haven't been resolved yet have no url.
+    return f"[{song.title}]({song.url})" if song.url else song.title
 
 
 class Music(commands.Cog):
@@ -156,6 +968,20 @@ class Music(commands.Cog):
 
         self.bot = bot
         self.states = {}
+        # Queues saved before the last restart, restored by the guild's next
+        # command.
+        self.saved = {}
+        self.restored = asyncio.ensure_future(self.load_saved())
+        waffle.metrics.gauge("music_states", lambda: len(self.states))
+        waffle.metrics.gauge(
+            "music_states_connected",
+            lambda: sum(state.voice is not None for state in self.states.values()),
+        )
+        waffle.metrics.gauge(
+            "music_queued_songs",
+            lambda: sum(len(state.queue) for state in self.states.values()),
+        )
+        waffle.metrics.gauge("music_saved_queues", lambda: len(self.saved))
 
     def is_dj():
         """Check if a specifed channel exists."""
@@ -174,11 +1000,64 @@ class Music(commands.Cog):
 
         return commands.check(predicate)
 
+    async def load_saved(self):
+        if not waffle.queue_store.ENABLED:
+            return
+        start = time.perf_counter()
+        try:
+            self.saved = await waffle.queue_store.load()
+        except Exception as e:
+            print(f"Couldn't load saved queues: {e}", file=sys.stderr)
+        waffle.metrics.record("queue_store_load", time.perf_counter() - start)
+
+    def cog_unload(self):
+        for music_state in self.states.values():
+            music_state.unload()
+
     async def cog_before_invoke(self, ctx):
-        ctx.music_state = self.states.setdefault(
-            ctx.guild.id, GuildMusicState(ctx, self.bot.loop)
+        music_state = self.states.get(ctx.guild.id)
+        if music_state is None:
+            await self.restored
+            music_state = GuildMusicState(ctx, self.bot.loop)
+            saved = self.saved.pop(ctx.guild.id, None)
+            if saved:
+                music_state.restore(saved)
+            self.states[ctx.guild.id] = music_state
+            waffle.metrics.increment("music_states_created")
+        music_state.channel = ctx.channel
+        music_state.voice = ctx.guild.voice_client
+        ctx.music_state = music_state
+        self.keep_alive(ctx.guild.id)
+
+    async def cog_after_invoke(self, ctx):
+        # Counts from the end of commands that took long, like queueing a
+        # playlist.
+        self.keep_alive(ctx.guild.id)
+
+    def keep_alive(self, guild_id):
+        """Restarts the countdown to evicting a guild's music state."""
+        music_state = self.states.get(guild_id)
+        if music_state is None:
+            return
+        if music_state.idle_timer:
+            music_state.idle_timer.cancel()
+        music_state.idle_timer = self.bot.loop.call_later(
+            IDLE_TIMEOUT, self.evict_state, guild_id
         )
-        ctx.music_state.voice = ctx.guild.voice_client
+
+    def evict_state(self, guild_id):
+        """Drops a guild's music state if it's idle, or checks again later."""
+        music_state = self.states.get(guild_id)
+        if music_state is None:
+            return
+        if not music_state.is_idle():
+            self.keep_alive(guild_id)
+            return
+        del self.states[guild_id]
+        # Releases anything left, like pins of songs that failed to play.
+        music_state.cleanup()
+        music_state.idle_timer = None
+        waffle.metrics.increment("music_states_evicted")
 
     @staticmethod
     async def on_ready():
@@ -186,18 +1065,18 @@ class Music(commands.Cog):
         print("Music is ready!")
 
     @staticmethod
-    def clear_song_cache():
-        """Clears downloaded songs."""
-        songs = Path.iterdir("cache")
-        for item in songs:
-            if item.endswith(".opus"):
-                os.remove(item)
+    async def clear_song_cache():
+        """Clears downloaded songs that aren't queued or playing."""
+        return await waffle.audio_cache.evict()
 
     @commands.command(name="play", aliases=["p"])
     @commands.guild_only()
     @is_dj()
     async def play(self, ctx, *, request):
-        """Plays or adds a song to queue. Args: <search terms/url>"""
+        """Plays or adds songs to queue. Args: <search terms/url/playlist url>
+
+        Several songs can be queued at once, one per line.
+        """
         author = ctx.author
         music_state = ctx.music_state
 
@@ -212,26 +1091,105 @@ class Music(commands.Cog):
             )
             return
 
+        if len(music_state.queue) >= music_state.queue_capacity:
+            await ctx.send(
+                ":no_entry_sign: " "The queue is full! Please try again later."
+            )
+            return
+
         voice_channel = author.voice.channel
         if not music_state.voice or voice_channel != music_state.voice.channel:
-            music_state.voice = await voice_channel.connect()
+            music_state.voice = await voice_channel.connect(
+                cls=waffle.audio_worker.voice_client_class()
+            )
 
-        song = Song()
-        if not song.create(ctx, request):
-            await ctx.send(":no_entry_sign: Song not found!")
+        requested_at = time.perf_counter()
+        lines = [line.strip() for line in request.splitlines() if line.strip()]
+        if len(lines) > 1 or PLAYLIST.match(request):
+            await self.play_many(ctx, lines, requested_at)
             return
 
-        if not music_state.voice.is_playing():
-            music_state.add_to_queue(song)
-            await music_state.play_next_song(music_state.next_song_info())
-            await ctx.send(embed=song.embed(author, "added to queue"))
-        elif len(music_state.queue) >= music_state.queue_capacity:
-            await ctx.send(
-                ":no_entry_sign: " "The queue is full! Please try again later."
+        status = await ctx.send(f":mag: Resolving `{request}`...")
+        task = asyncio.ensure_future(music_state.resolve(Song(request, author.id)))
+        music_state.resolving.add(task)
+        try:
+            song = await task
+        except asyncio.CancelledError:
+            await status.edit(content=":no_entry_sign: Cancelled.")
+            return
+        finally:
+            music_state.resolving.discard(task)
+
+        if not song:
+            await status.edit(content=":no_entry_sign: Song not found!")
+            return
+        if not music_state.voice:
+            # Stopped while the song was being resolved.
+            await status.edit(content=":no_entry_sign: Cancelled.")
+            return
+
+        music_state.add_to_queue(song)
+        if not music_state.current_song:
+            await music_state.play_next_song(music_state.next_song_info(), requested_at)
+        await status.edit(
+            content=None,
+            embed=song.embed(author, "added to queue", music_state.position(song)),
+        )
+
+    async def play_many(self, ctx, requests, requested_at):
+        """Queues a playlist or several songs as placeholders."""
+        music_state = ctx.music_state
+        if len(requests) == 1:
+            status = await ctx.send(":mag: Loading playlist...")
+            entries = await music_state.loop.run_in_executor(
+                executor, extract_playlist, requests[0]
             )
+            songs = [
+                Song(
+                    f"https://www.youtube.com/watch?v={entry['id']}",
+                    ctx.author.id,
+                    video_id=entry["id"],
+                    title=entry.get("title"),
+                )
+                for entry in entries
+            ]
         else:
+            status = await ctx.send(f":mag: Queueing {len(requests)} songs...")
+            songs = [Song(request, ctx.author.id) for request in requests]
+
+        if not songs:
+            await status.edit(content=":no_entry_sign: Playlist not found!")
+            return
+        if not music_state.voice:
+            await status.edit(content=":no_entry_sign: Cancelled.")
+            return
+        room = music_state.queue_capacity - len(music_state.queue)
+        skipped = max(0, len(songs) - room)
+        songs = songs[: max(0, room)]
+        start = len(music_state.queue) + 1
+        for song in songs:
             music_state.add_to_queue(song)
-            await ctx.send(embed=song.embed(author, "added to queue"))
+
+        embed = discord.Embed(
+            title=f"Queued {len(songs)} songs",
+            colour=discord.Colour(0xFF0000),
+            description="\n".join(
+                f"{position}. {song.title}"
+                for position, song in enumerate(songs[:10], start)
+            ),
+        )
+        embed.set_author(
+            name=f"{ctx.author.name} added to queue", icon_url=ctx.author.avatar_url
+        )
+        if len(songs) > 10:
+            embed.set_footer(text=f"and {len(songs) - 10} more")
+        if skipped:
+            embed.add_field(
+                name="The queue is full!", value=f"{skipped} songs weren't queued."
+            )
+        await status.edit(content=None, embed=embed)
+        if songs and not music_state.current_song:
+            await music_state.play_next_song(music_state.next_song_info(), requested_at)
 
     @commands.command(name="stop", aliases=["disconnect"])
     @commands.guild_only()
@@ -268,7 +1226,7 @@ class Music(commands.Cog):
     @commands.guild_only()
     @is_dj()
     async def resume(self, ctx):
-        """Resumes the voice client."""
+        """Resumes the voice client, or the queue saved before a restart."""
         music_state = ctx.music_state
 
         if music_state.voice is not None:
@@ -277,6 +1235,14 @@ class Music(commands.Cog):
             else:
                 music_state.voice.resume()
                 await ctx.send(":arrow_forward: Resumed!")
+        elif music_state.queue and ctx.author.voice:
+            # Picks the queue up where it was before a restart.
+            requested_at = time.perf_counter()
+            music_state.voice = await ctx.author.voice.channel.connect(
+                cls=waffle.audio_worker.voice_client_class()
+            )
+            await ctx.send(":arrow_forward: Resumed the queue!")
+            await music_state.play_next_song(music_state.next_song_info(), requested_at)
         else:
             await ctx.send(":no_entry_sign: I'm not connected to voice!")
 
@@ -289,10 +1255,9 @@ class Music(commands.Cog):
             await ctx.send(":no_entry_sign: Volume over 100 is prohibited.")
         else:
             music_state = ctx.music_state
-            music_state.volume = volume / 1000
+            music_state.set_volume(volume / 1000)
 
             if music_state.voice:
-                music_state.voice.source.volume = music_state.volume
                 await ctx.send(f":loud_sound: Changed volume to {music_state.volume}")
             else:
                 await ctx.send(":no_entry_sign: I'm not connected to voice!")
@@ -311,10 +1276,10 @@ class Music(commands.Cog):
     async def repeat(self, ctx):
         music_state = ctx.music_state
         if music_state.mode != "repeat":
-            music_state.mode = "repeat"
+            music_state.set_mode("repeat")
             await ctx.send(":repeat_one: Repeat on!")
         else:
-            music_state.mode = None
+            music_state.set_mode(None)
             await ctx.send(":repeat_one: Repeat off!")
 
     @commands.command(name="loop", aliases=["l"])
@@ -323,58 +1288,59 @@ class Music(commands.Cog):
     async def loop(self, ctx):
         music_state = ctx.music_state
         if music_state.mode != "loop":
-            music_state.mode = "loop"
-            music_state.add_to_queue(music_state.current_song)
+            music_state.set_mode("loop")
+            song = music_state.current_song
+            if song and song not in music_state.queue:
+                music_state.add_to_queue(song)
             await ctx.send(":repeat: Loop on!")
         else:
-            music_state.mode = None
+            music_state.set_mode(None)
             await ctx.send(":repeat: Loop off!")
 
-    @commands.command(name="queue", aliases=["q"])
+    @commands.command(name="search")
     @commands.guild_only()
-    async def queue(self, ctx):
-        music_state = ctx.music_state
-        queue = music_state.queue
-        if len(queue) < 1 and not music_state.current_song:
-            await ctx.send(":no_entry_sign: Queue is empty!")
+    async def search_cache(self, ctx, *, query):
+        """Lists downloaded songs matching a search. Args: <search terms>"""
+        found = waffle.song_index.search(query)
+        if not found:
+            await ctx.send(":no_entry_sign: No downloaded songs found!")
             return
-        song = music_state.current_song
-
-        if not music_state.mode:
-            mode = ":play_pause:"
-        elif music_state.mode == "loop":
-            mode = ":repeat:"
-        elif music_state.mode == "repeat":
-            mode = ":repeat_one:"
-
         embed = discord.Embed(
-            title=f"Queue for {ctx.guild}",
+            title=f"Downloaded songs matching {query}",
             colour=discord.Colour(0xF8E71C),
-            description=f"{mode} Now Playing:\n "
-            f"[{song.title}]({song.url}) "
-            f"| {song.duration} Requested by "
-            f"{song.requested_by.mention}\n\n\n"
-            f":arrow_down: Up next :arrow_down:",
         )
-        for i, song in enumerate(queue):
-            music_state.queue[i].position = i + 1
+        for position, info in enumerate(found, 1):
+            song = Song(info["webpage_url"], ctx.author.id)
+            song.load(info)
             embed.add_field(
-                name=f"{song.position}.",
-                value=f"[{song.title}]({song.url}) "
-                f"| {song.duration} "
-                f"Requested by {song.requested_by.mention}",
+                name=f"{position}.",
+                value=f"{song_link(song)} | {song.duration} | {song.uploader}",
                 inline=False,
             )
         await ctx.send(embed=embed)
 
+    @commands.command(name="queue", aliases=["q"])
+    @commands.guild_only()
+    async def queue(self, ctx):
+        music_state = ctx.music_state
+        queue = music_state.queue
+        if len(queue) < 1 and not music_state.current_song:
+            await ctx.send(":no_entry_sign: Queue is empty!")
+            return
+        await waffle.reaction.Paginator(
+            ctx, music_state.queue_page, music_state.queue_page_count
+        ).start()
+
     @commands.command(name="remove")
     @commands.guild_only()
     async def remove(self, ctx, position: int):
         music_state = ctx.music_state
         try:
-            song = music_state.queue[position - 1]
-            del music_state.queue[position - 1]
-            await ctx.send(embed=song.embed(ctx.author, "removed from queue"))
+            song = music_state.queue.pop(position - 1)
+            if song.resolved:
+                waffle.audio_cache.unpin(song.video_id)
+            music_state.prefetch()
+            await ctx.send(embed=song.embed(ctx.author, "removed from queue", position))
         except IndexError:
             await ctx.send(":no_entry_sign: Position out of range!")
 
@@ -383,11 +1349,9 @@ class Music(commands.Cog):
     async def play_next(self, ctx, position: int):
         music_state = ctx.music_state
         try:
-            song = music_state.queue[position - 1]
-            del music_state.queue[position - 1]
-            music_state.queue.appendleft(song)
-            song.position = 1
-            await ctx.send(embed=song.embed(ctx.author, "moved next in queue"))
+            song = music_state.queue.move(position - 1, 0)
+            music_state.prefetch()
+            await ctx.send(embed=song.embed(ctx.author, "moved next in queue", 1))
         except IndexError:
             await ctx.send(":no_entry_sign: Position out of range!")
 
@@ -396,10 +1360,9 @@ class Music(commands.Cog):
     async def play_later(self, ctx, position: int):
         music_state = ctx.music_state
         try:
-            song = music_state.queue[position - 1]
-            del music_state.queue[position - 1]
-            music_state.queue.append(song)
-            song.position = len(music_state.queue)
-            await ctx.send(embed=song.embed(ctx.author, "moved later in queue"))
+            last = len(music_state.queue)
+            song = music_state.queue.move(position - 1, last)
+            music_state.prefetch()
+            await ctx.send(embed=song.embed(ctx.author, "moved later in queue", last))
         except IndexError:
             await ctx.send(":no_entry_sign: Position out of range!")
@@ -0,0 +1,148 @@
+"""Guilds' music queues, saved to the database so they survive restarts.
+
+Changes to a queue are appended to the music_queue_changes table, one row
+per guild for every change made in the same pass of the event loop (a whole
+playlist is one row), going through waffle.database's group commit. Once a
+guild has piled up enough changes, its whole queue is written to
+music_queues instead and the changes it covers are deleted. Changes are
+numbered per guild, so whatever a crash leaves behind, loading only replays
+the changes newer than the saved queue.
+"""
+import asyncio
+import datetime
+from collections import Counter, defaultdict
+
+from sqlalchemy.sql import select
+
+import waffle.config
+import waffle.database
+import waffle.metrics
+from waffle.tables import MusicQueuesTable, MusicQueueChangesTable
+
+CONFIG = waffle.config.CONFIG["config"]
+
+ENABLED = CONFIG.get("persist_queues", True)
+# Changes recorded for a guild before its whole queue is written instead.
+COMPACT_EVERY = CONFIG.get("queue_compact_every", 100)
+
+# Number of the last change recorded per guild, and the changes recorded
+# since its queue was last written whole.
+_sequences = {}
+_pending = Counter()
+# Changes waiting to be written at the end of this pass of the event loop.
+_unwritten = defaultdict(list)
+
+
+def empty():
+    return {"mode": None, "volume": None, "current": None, "songs": []}
+
+
+def apply(state, change):
+    """Applies a recorded change to a saved queue."""
+    op, *args = change
+    if op == "insert":
+        index, song = args
+        state["songs"].insert(index, song)
+    elif op == "pop":
+        del state["songs"][args[0]]
+    elif op == "clear":
+        state["songs"].clear()
+    else:
+        # "current", "mode" or "volume".
+        state[op] = args[0]
+
+
+async def load():
+    """Returns the saved queues that aren't empty, by guild id."""
+    # Changes made by a cog that was just unloaded may still be on their way.
+    await waffle.database.flush()
+    _sequences.clear()
+    _pending.clear()
+    states = {}
+    async with waffle.database.engine.begin() as conn:
+        for row in await conn.execute(select(MusicQueuesTable)):
+            states[row["guild_id"]] = row["state"]
+            _sequences[row["guild_id"]] = row["sequence"]
+        rows = await conn.execute(
+            select(MusicQueueChangesTable).order_by(
+                MusicQueueChangesTable.c.guild_id, MusicQueueChangesTable.c.sequence
+            )
+        )
+        for row in rows:
+            guild_id = row["guild_id"]
+            if row["sequence"] <= _sequences.get(guild_id, 0):
+                # Already in the saved queue; a crash kept it from being deleted.
+                continue
+            if guild_id not in states:
+                states[guild_id] = empty()
+            for change in row["changes"]:
+                apply(states[guild_id], change)
+            _sequences[guild_id] = row["sequence"]
+            _pending[guild_id] += len(row["changes"])
+    waffle.metrics.increment("queue_store_loaded", len(states))
+    return {
+        guild_id: state
+        for guild_id, state in states.items()
+        if state["current"] or state["songs"]
+    }
+
+
+def record(guild_id, change, dump):
+    """Saves a change to a guild's queue.
+
+    `dump()` returns the whole queue, which is saved instead once enough
+    changes piled up.
+    """
+    if not ENABLED:
+        return
+    _sequences[guild_id] = _sequences.get(guild_id, 0) + 1
+    _pending[guild_id] += 1
+    waffle.metrics.increment("queue_store_changes")
+    if _pending[guild_id] >= COMPACT_EVERY:
+        save(guild_id, dump())
+        return
+    if not _unwritten:
+        asyncio.get_event_loop().call_soon(_write)
+    _unwritten[guild_id].append(change)
+
+
+def _write():
+    rows = [
+        {"guild_id": guild_id, "sequence": _sequences[guild_id], "changes": changes}
+        for guild_id, changes in _unwritten.items()
+    ]
+    _unwritten.clear()
+    if rows:
+        asyncio.ensure_future(
+            waffle.database.write(MusicQueueChangesTable.insert(), rows)
+        )
+
+
+def save(guild_id, state):
+    """Saves a guild's whole queue, replacing its recorded changes."""
+    if not ENABLED:
+        return
+    # They're part of the queue being saved.
+    _unwritten.pop(guild_id, None)
+    sequence = _sequences.setdefault(guild_id, 0)
+    _pending[guild_id] = 0
+    waffle.metrics.increment("queue_store_compactions")
+    asyncio.ensure_future(
+        waffle.database.write(
+            MusicQueuesTable.insert().prefix_with("OR REPLACE"),
+            {
+                "guild_id": guild_id,
+                "sequence": sequence,
+                "state": state,
+                "updated": datetime.datetime.now(),
+            },
+        )
+    )
+    asyncio.ensure_future(
+        waffle.database.write(
+            MusicQueueChangesTable.delete().where(
+                (MusicQueueChangesTable.c.guild_id == guild_id)
+                & (MusicQueueChangesTable.c.sequence <= sequence)
+            )
+        )
+    )
@@ -0,0 +1,69 @@
+"""Messages that are paged through with reactions."""
+import asyncio
+
+import discord
+
+PREVIOUS = "\N{BLACK LEFT-POINTING TRIANGLE}"
+NEXT = "\N{BLACK RIGHT-POINTING TRIANGLE}"
+
+
+class Paginator:
+    """Shows one page at a time in a single message, turned with reactions.
+
+    `render(page)` returns the embed of a page, counting from 0, and
+    `page_count()` how many pages there are. Both are called only for the
+    page being shown, so they see whatever changed in the meantime.
+    """
+
+    def __init__(self, ctx, render, page_count, timeout=120):
+        self.ctx = ctx
+        self.render = render
+        self.page_count = page_count
+        self.timeout = timeout
+        self.page = 0
+        self.message = None
+
+    async def start(self):
+        """Sends the first page and turns pages until the reactions time out."""
+        self.message = await self.ctx.send(embed=self.render(self.page))
+        if self.page_count() < 2:
+            return
+        try:
+            for emoji in (PREVIOUS, NEXT):
+                await self.message.add_reaction(emoji)
+        except discord.Forbidden:
+            # Without Add Reactions, only the first page is shown.
+            return
+
+        def check(reaction, user):
+            return (
+                reaction.message.id == self.message.id
+                and str(reaction.emoji) in (PREVIOUS, NEXT)
+                and user != self.ctx.bot.user
+            )
+
+        while True:
+            try:
+                reaction, user = await self.ctx.bot.wait_for(
+                    "reaction_add", check=check, timeout=self.timeout
+                )
+            except asyncio.TimeoutError:
+                break
+            await self.turn(-1 if str(reaction.emoji) == PREVIOUS else 1)
+            try:
+                await self.message.remove_reaction(reaction.emoji, user)
+            except discord.Forbidden:
+                # Without Manage Messages, users have to unreact themselves.
+                pass
+
+        try:
+            await self.message.clear_reactions()
+        except discord.HTTPException:
+            pass
+
+    async def turn(self, step):
+        """Moves `step` pages on, editing the message if the page changed."""
+        page = max(0, min(self.page + step, self.page_count() - 1))
+        if page != self.page:
+            self.page = page
+            await self.message.edit(embed=self.render(page))
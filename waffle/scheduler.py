@@ -1,17 +1,39 @@
 import re
+import os
 import sys
+import heapq
+import socket
 import datetime
 import asyncio
 
-import discord.utils
-from sqlalchemy.sql import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql import select, func, or_, true, bindparam
 
 import waffle
-import waffle.moderation
 from waffle.tables import TasksTable
 
 CONFIG = waffle.config.CONFIG
 
+# Identifies this process when it claims tasks, so several processes can share
+# the tasks table without running the same task twice.
+WORKER_ID = (
+    CONFIG["database"].get("worker_id") or f"{socket.gethostname()}-{os.getpid()}"
+)
+
+# Upcoming task deadlines. The timer only ever looks at the head of the heap,
+# so it can sleep until exactly the next deadline. The tasks themselves stay in
+# the database and are claimed with an indexed range query once they are due.
+_heap = []
+_wakeup = asyncio.Event()
+_runner = None
+# Job handlers by function name. Cogs register theirs when they are loaded.
+_handlers = {}
+_semaphore = asyncio.Semaphore(CONFIG["database"].get("max_concurrent_tasks", 10))
+# Expiry of this process's latest claim. Every claim's lease ends later than
+# the one before, which is how its tasks are told apart from those of
+# earlier claims that failed and are still leased to this worker.
+_last_lease = datetime.datetime.min
+
 
 def string_to_seconds(string):
     time_mapping = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800, "y": 31536000}
@@ -26,58 +48,257 @@ def string_to_seconds(string):
     return seconds
 
 
-async def set_task(ctx, function, duration, user_id):
+def _push(time):
+    """Adds a deadline to the heap and wakes the timer if it is now the earliest."""
+    heapq.heappush(_heap, time)
+    if _heap[0] == time:
+        _wakeup.set()
+
+
+def register(function, handler):
+    """Registers the coroutine that runs jobs with the given function name."""
+    _handlers[function] = handler
+    # Jobs of this type may already be due.
+    _wakeup.set()
+
+
+def unregister(function):
+    _handlers.pop(function, None)
+
+
+async def schedule(function, time, interval=None, key=None, payload=None, **columns):
+    """Adds a job to the queue and returns its id.
+
+    Jobs with an interval (in seconds) are rescheduled after every run instead
+    of being deleted. Jobs with a key are only added if no job with that key
+    exists, so recurring jobs can be scheduled on every startup. Any
+    JSON-serialisable payload is stored with the job and passed to its
+    handler along with the rest of the row.
+    """
+    job = {
+        "function": function,
+        "time": time,
+        "interval": interval,
+        "key": key,
+        "payload": payload,
+        **columns,
+    }
+    try:
+        result = await waffle.database.write(TasksTable.insert(), job)
+    except IntegrityError:
+        if key is None:
+            raise
+        return None
+    _push(time)
+    return result.inserted_primary_key[0]
+
+
+async def schedule_many(jobs):
+    """Adds many jobs (dicts of schedule()'s arguments) with one statement."""
+    defaults = {column.name: None for column in TasksTable.c if column.name != "id"}
+    jobs = [{**defaults, **job} for job in jobs]
+    await waffle.database.write(TasksTable.insert(), jobs)
+    if jobs:
+        _push(min(job["time"] for job in jobs))
+
+
+async def set_task(ctx, function, duration, user_id, reason=None):
+    return await schedule(
+        function,
+        datetime.timedelta(seconds=string_to_seconds(duration))
+        + datetime.datetime.now(),
+        guild_id=ctx.guild.id,
+        message_id=ctx.message.id,
+        channel_id=ctx.channel.id,
+        user_id=user_id,
+        moderator_id=ctx.author.id,
+        reason=reason,
+    )
+
+
+def _owned():
+    """Limits queries to guilds on this process's shards."""
+    shard_count = waffle.bot.shard_count
+    if not shard_count or shard_count == 1:
+        return true()
+    shard_ids = getattr(waffle.bot, "shard_ids", None) or [waffle.bot.shard_id]
+    shard = TasksTable.c.guild_id.op(">>")(22) % shard_count
+    owned = shard.in_(shard_ids)
+    if 0 in shard_ids:
+        # Jobs that don't belong to a guild run on the first shard.
+        owned = or_(owned, TasksTable.c.guild_id.is_(None))
+    return owned
+
+
+def _runnable():
+    """Limits queries to jobs this process owns and has a handler for."""
+    return _owned() & TasksTable.c.function.in_(list(_handlers))
+
+
+async def next_task_time(after):
+    """Returns the earliest deadline or lease expiry later than `after`."""
     async with waffle.database.engine.begin() as conn:
-        await conn.execute(
-            TasksTable.insert(),
-            {
-                "guild_id": ctx.guild.id,
-                "message_id": ctx.message.id,
-                "channel_id": ctx.channel.id,
-                "time": datetime.timedelta(seconds=string_to_seconds(duration))
-                + datetime.datetime.now(),
-                "function": function,
-                "user_id": user_id,
-            },
+        time = await conn.scalar(
+            select(func.min(TasksTable.c.time))
+            .where(TasksTable.c.time > after)
+            .where(TasksTable.c.lease_expires.is_(None))
+            .where(_runnable())
+        )
+        lease = await conn.scalar(
+            select(func.min(TasksTable.c.lease_expires))
+            .where(TasksTable.c.lease_expires > after)
+            .where(_runnable())
         )
+    return min(filter(None, (time, lease)), default=None)
 
 
-async def check_for_tasks():
+async def claim_due_tasks(now, limit):
+    """Leases up to `limit` due tasks to this worker and returns them.
+
+    A task can be claimed when it has no lease or its lease has expired, so
+    the tasks of a crashed worker are picked up once their leases run out.
+    The claim is a single UPDATE, which SQLite runs under its write lock.
+    """
+    global _last_lease
+    lease = max(
+        now + datetime.timedelta(seconds=CONFIG["database"].get("lease_duration", 60)),
+        _last_lease + datetime.timedelta(microseconds=1),
+    )
+    _last_lease = lease
+    claimable = (
+        (TasksTable.c.time <= now)
+        & or_(TasksTable.c.lease_expires.is_(None), TasksTable.c.lease_expires <= now)
+        & _runnable()
+    )
     async with waffle.database.engine.begin() as conn:
-        tasks = await conn.execute(select(TasksTable))
-    for task in tasks:
-        if datetime.datetime.now() >= task["time"]:
-            guild_id = task["guild_id"]
-            user_id = task["user_id"]
-            guild = waffle.bot.get_guild(guild_id)
-            channel = guild.get_channel(task["channel_id"])
-            message = await channel.fetch_message(task["message_id"])
-            ctx = await waffle.bot.get_context(message)
-            user = guild.get_member(user_id)
-
-            if task["function"] == "unmute":
-                muted = discord.utils.get(
-                    ctx.guild.roles, name=CONFIG["config"]["mute"]
+        await conn.execute(
+            TasksTable.update()
+            .where(
+                TasksTable.c.id.in_(
+                    select(TasksTable.c.id)
+                    .where(claimable)
+                    .order_by(TasksTable.c.time)
+                    .limit(limit)
                 )
+            )
+            .where(claimable)
+            .values(worker_id=WORKER_ID, lease_expires=lease)
+        )
+        tasks = await conn.execute(
+            select(TasksTable)
+            .where(TasksTable.c.worker_id == WORKER_ID)
+            .where(TasksTable.c.lease_expires == lease)
+        )
+        return tasks.all()
 
-                if muted in user.roles:
-                    await user.remove_roles(muted, reason="Tempmute")
-                await waffle.moderation.Moderation.mod_log(
-                    ctx, "Unmute", user, "Tempmute"
-                )
-            elif task["function"] == "unban":
-                banned = await guild.fetch_ban(user)
-                if banned:
-                    await guild.unban(user, reason="Tempban")
-                await waffle.moderation.Moderation.mod_log(
-                    ctx, "Unban", user, "Tempban"
-                )
-            async with waffle.database.engine.begin() as conn:
-                await conn.execute(
-                    TasksTable.delete().where(
-                        TasksTable.c.message_id == task["message_id"]
-                    )
+
+async def run_task(task):
+    await _handlers[task["function"]](task)
+
+
+async def finish_tasks(tasks):
+    """Deletes finished one-off jobs and reschedules recurring ones."""
+    now = datetime.datetime.now()
+    done = [task["id"] for task in tasks if not task["interval"]]
+    recurring = []
+    for task in tasks:
+        if task["interval"]:
+            interval = datetime.timedelta(seconds=task["interval"])
+            # Skip runs that were missed while no worker was up.
+            missed = (now - task["time"]) // interval + 1
+            recurring.append(
+                {"_id": task["id"], "_time": task["time"] + interval * missed}
+            )
+    writes = []
+    if done:
+        writes.append(
+            waffle.database.write(
+                TasksTable.delete()
+                .where(TasksTable.c.id.in_(done))
+                .where(TasksTable.c.worker_id == WORKER_ID)
+            )
+        )
+    if recurring:
+        writes.append(
+            waffle.database.write(
+                TasksTable.update()
+                .where(TasksTable.c.id == bindparam("_id"))
+                .where(TasksTable.c.worker_id == WORKER_ID)
+                .values(time=bindparam("_time"), worker_id=None, lease_expires=None),
+                recurring,
+            )
+        )
+    await asyncio.gather(*writes)
+    for job in recurring:
+        _push(job["_time"])
+
+
+async def _dispatch(task, guild_semaphore):
+    """Runs a task within the global and per-guild concurrency limits."""
+    async with guild_semaphore, _semaphore:
+        try:
+            await run_task(task)
+        except Exception as e:
+            print(
+                "Task {} failed because of error {}.".format(task["id"], e),
+                file=sys.stderr,
+            )
+            return False
+    return True
+
+
+async def check_for_tasks():
+    """Runs every due task this worker can claim."""
+    now = datetime.datetime.now()
+    limit = CONFIG["database"].get("batch_size", 100)
+    per_guild = CONFIG["database"].get("max_concurrent_tasks_per_guild", 2)
+    guild_semaphores = {}
+    while True:
+        tasks = await claim_due_tasks(now, limit)
+        results = await asyncio.gather(
+            *(
+                _dispatch(
+                    task,
+                    guild_semaphores.setdefault(
+                        task["guild_id"], asyncio.Semaphore(per_guild)
+                    ),
                 )
+                for task in tasks
+            )
+        )
+        # Failed tasks keep their lease and are retried once it expires.
+        done = [task for task, ok in zip(tasks, results) if ok]
+        if done:
+            await finish_tasks(done)
+        if len(tasks) < limit:
+            break
+
+    while _heap and _heap[0] <= now:
+        heapq.heappop(_heap)
+    time = await next_task_time(now)
+    if time and time not in _heap:
+        heapq.heappush(_heap, time)
+
+
+async def _timer():
+    # Other workers add tasks this process never hears about, so the timer
+    # never sleeps longer than resync_interval without asking the database.
+    resync = CONFIG["database"].get("resync_interval", 60)
+    while True:
+        _wakeup.clear()
+        await check_for_tasks()
+        timeout = resync
+        if _heap:
+            timeout = min(timeout, (_heap[0] - datetime.datetime.now()).total_seconds())
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
 
-    await asyncio.sleep(CONFIG["database"]["check_interval"])
-    await check_for_tasks()
+def start():
+    """Starts the scheduler timer once, no matter how often on_ready fires."""
+    global _runner
+    if _runner is None or _runner.done():
+        _runner = asyncio.ensure_future(_timer())
+    return _runner
@@ -0,0 +1,56 @@
+"""Sharing one run of a slow call among everyone asking for it at once."""
+import asyncio
+
+import waffle.metrics
+
+
+class _Call:
+    __slots__ = ("task", "waiters", "abandoned")
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+        self.abandoned = False
+
+
+class SingleFlight:
+    """Runs at most one call per key at a time.
+
+    Whoever asks for a key that is already being worked on waits for that
+    call's result instead of starting another one, which is counted under the
+    `counter` metric. The call is only cancelled once everyone waiting for it
+    was, and is left to wind down before the key can be run again.
+    """
+
+    def __init__(self, counter):
+        self.counter = counter
+        self._calls = {}
+
+    def __contains__(self, key):
+        return key in self._calls
+
+    async def run(self, key, function, *args):
+        """Returns the result of `await function(*args)`, shared per key."""
+        while True:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call(asyncio.ensure_future(function(*args)))
+                call.task.add_done_callback(lambda task: self._forget(key, call))
+                break
+            if not call.abandoned:
+                waffle.metrics.increment(self.counter)
+                break
+            await asyncio.wait([call.task])
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if not call.waiters and not call.task.done():
+                call.abandoned = True
+                call.task.cancel()
+
+    def _forget(self, key, call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
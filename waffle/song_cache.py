@@ -0,0 +1,136 @@
+"""Persistent cache of youtube search results and video metadata."""
+import re
+import asyncio
+import datetime
+from collections import OrderedDict
+
+from sqlalchemy.sql import select
+
+import waffle.config
+import waffle.database
+from waffle.tables import SongsTable, SongQueriesTable
+
+CONFIG = waffle.config.CONFIG["config"]
+
+# The only fields of youtube_dl's info dict that Song needs.
+METADATA = (
+    "id",
+    "webpage_url",
+    "title",
+    "duration",
+    "uploader",
+    "channel_url",
+    "artist",
+)
+
+
+class LRU(OrderedDict):
+    """Dict that drops its least recently used items past a maximum size."""
+
+    def __init__(self, size):
+        super().__init__()
+        self.size = size
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        self.move_to_end(key)
+        return self[key]
+
+    def put(self, key, value):
+        self[key] = value
+        self.move_to_end(key)
+        while len(self) > self.size:
+            self.popitem(last=False)
+
+
+_queries = LRU(CONFIG.get("song_cache_size", 1024))
+_songs = LRU(CONFIG.get("song_cache_size", 1024))
+
+
+def normalize(query):
+    # Video ids in URLs are case-sensitive.
+    if re.match("https?://", query):
+        return query.strip()
+    return " ".join(query.lower().split())
+
+
+def _expired(updated, now):
+    return now - updated > datetime.timedelta(days=CONFIG.get("song_cache_ttl", 30))
+
+
+async def lookup(query):
+    """Returns the cached metadata for a search query, if any."""
+    query = normalize(query)
+    now = datetime.datetime.now()
+
+    entry = _queries.get(query)
+    if entry is None:
+        async with waffle.database.engine.begin() as conn:
+            row = (
+                await conn.execute(
+                    select(SongQueriesTable).where(SongQueriesTable.c.query == query)
+                )
+            ).first()
+        if row is None:
+            return None
+        entry = (row["video_id"], row["updated"])
+        _queries.put(query, entry)
+    video_id, updated = entry
+    if _expired(updated, now):
+        return None
+    return await lookup_video(video_id)
+
+
+async def lookup_video(video_id):
+    """Returns the cached metadata for a video id, if any."""
+    now = datetime.datetime.now()
+
+    entry = _songs.get(video_id)
+    if entry is None:
+        async with waffle.database.engine.begin() as conn:
+            row = (
+                await conn.execute(
+                    select(SongsTable).where(SongsTable.c.id == video_id)
+                )
+            ).first()
+        if row is None:
+            return None
+        entry = ({key: row[key] for key in METADATA}, row["updated"])
+        _songs.put(video_id, entry)
+    info, updated = entry
+    if _expired(updated, now):
+        return None
+    return info
+
+
+async def store(query, info):
+    """Caches the video a query resolved to along with the video's metadata."""
+    query = normalize(query)
+    now = datetime.datetime.now()
+    info = {key: info.get(key) for key in METADATA}
+
+    _queries.put(query, (info["id"], now))
+    _songs.put(info["id"], (info, now))
+    await asyncio.gather(
+        waffle.database.write(
+            SongsTable.insert().prefix_with("OR REPLACE"), {**info, "updated": now}
+        ),
+        waffle.database.write(
+            SongQueriesTable.insert().prefix_with("OR REPLACE"),
+            {"query": query, "video_id": info["id"], "updated": now},
+        ),
+    )
+
+
+async def purge_expired(job):
+    """Scheduler job that deletes expired entries from the database."""
+    oldest = datetime.datetime.now() - datetime.timedelta(
+        days=CONFIG.get("song_cache_ttl", 30)
+    )
+    await asyncio.gather(
+        waffle.database.write(
+            SongQueriesTable.delete().where(SongQueriesTable.c.updated < oldest)
+        ),
+        waffle.database.write(SongsTable.delete().where(SongsTable.c.updated < oldest)),
+    )
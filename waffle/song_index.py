@@ -0,0 +1,144 @@
+"""Inverted index over the titles, uploaders and artists of cached songs.
+
+Lets searches for songs that are already in the cache be answered without
+asking youtube. The metadata of every song added to the cache is appended to
+a file next to it, which is read back (and compacted) on startup.
+"""
+import re
+import json
+from collections import defaultdict
+
+from sqlalchemy.sql import select
+
+import waffle.config
+import waffle.database
+import waffle.metrics
+import waffle.audio_cache
+from waffle.song_cache import METADATA
+from waffle.tables import SongsTable
+
+CONFIG = waffle.config.CONFIG["config"]
+
+FILE = waffle.audio_cache.DIRECTORY / "songs.jsonl"
+# Whether play looks for a confident local match before searching youtube.
+LOCAL_SEARCH = CONFIG.get("local_search", True)
+# Share of a song's title words a search has to contain to be played without
+# asking youtube. It also has to be the only cached song with every word of
+# the search, or youtube gets to pick.
+CONFIDENCE = 0.6
+
+# Metadata of indexed songs by video id, and video ids by word.
+_songs = {}
+_words = defaultdict(set)
+
+waffle.metrics.gauge("song_index_songs", lambda: len(_songs))
+waffle.metrics.gauge("song_index_words", lambda: len(_words))
+
+
+def words(text):
+    return set(re.findall(r"\w+", text.lower())) if text else set()
+
+
+def _song_words(info):
+    return words(info["title"]) | words(info["uploader"]) | words(info["artist"])
+
+
+def _index(info):
+    video_id = info["id"]
+    _remove(video_id)
+    _songs[video_id] = info
+    for word in _song_words(info):
+        _words[word].add(video_id)
+
+
+def _remove(video_id):
+    info = _songs.pop(video_id, None)
+    if info is None:
+        return
+    for word in _song_words(info):
+        _words[word].discard(video_id)
+        if not _words[word]:
+            del _words[word]
+
+
+async def load():
+    """Indexes the songs in the cache, once the cache has been scanned.
+
+    Songs cached before there was an index are looked up in the song cache.
+    """
+    _songs.clear()
+    _words.clear()
+    lines = 0
+    if FILE.exists():
+        with FILE.open() as file:
+            for line in file:
+                lines += 1
+                info = json.loads(line)
+                if waffle.audio_cache.cached(info["id"]):
+                    _index(info)
+
+    missing = [
+        video_id
+        for video_id in waffle.audio_cache.video_ids()
+        if video_id not in _songs
+    ]
+    for start in range(0, len(missing), 500):
+        async with waffle.database.engine.begin() as conn:
+            rows = await conn.execute(
+                select(SongsTable).where(
+                    SongsTable.c.id.in_(missing[start : start + 500])
+                )
+            )
+            for row in rows:
+                _index({key: row[key] for key in METADATA})
+
+    if lines != len(_songs):
+        with FILE.open("w") as file:
+            file.writelines(json.dumps(info) + "\n" for info in _songs.values())
+
+
+def add(info):
+    """Indexes a song that was just added to the cache."""
+    info = {key: info.get(key) for key in METADATA}
+    _index(info)
+    with FILE.open("a") as file:
+        file.write(json.dumps(info) + "\n")
+
+
+def search(query, limit=10):
+    """Returns the metadata of the cached songs best matching a search.
+
+    Songs have to contain every word of the search, and are ranked by the
+    share of their title it covers.
+    """
+    return [info for score, info in _matches(query)[:limit]]
+
+
+def match(query):
+    """Returns the metadata of the cached song a search is clearly after."""
+    if not LOCAL_SEARCH or re.match("https?://", query):
+        return None
+    matches = _matches(query)
+    if len(matches) != 1 or matches[0][0] < CONFIDENCE:
+        return None
+    waffle.metrics.increment("song_index_matches")
+    return matches[0][1]
+
+
+def _matches(query):
+    wanted = words(query)
+    if not wanted:
+        return []
+    postings = sorted((_words.get(word, set()) for word in wanted), key=len)
+    found = set.intersection(*postings)
+    matches = []
+    for video_id in found:
+        if not waffle.audio_cache.cached(video_id):
+            # Evicted since it was indexed.
+            _remove(video_id)
+            continue
+        info = _songs[video_id]
+        title = words(info["title"])
+        matches.append((len(wanted & title) / len(title) if title else 0, info))
+    matches.sort(key=lambda match: match[0], reverse=True)
+    return matches
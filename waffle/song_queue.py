@@ -0,0 +1,198 @@
+"""Music queue with logarithmic time access, insertion and removal by position."""
+import random
+
+
+class _Node:
+    __slots__ = ("song", "priority", "size", "left", "right", "parent")
+
+    def __init__(self, song):
+        self.song = song
+        self.priority = random.random()
+        self.size = 1
+        self.left = self.right = self.parent = None
+
+
+def _size(node):
+    return node.size if node else 0
+
+
+def _update(node):
+    size = 1
+    if node.left:
+        size += node.left.size
+        node.left.parent = node
+    if node.right:
+        size += node.right.size
+        node.right.parent = node
+    node.size = size
+
+
+def _merge(left, right):
+    """Joins two treaps, every song of `left` coming first."""
+    if not left or not right:
+        return left or right
+    if left.priority > right.priority:
+        left.right = _merge(left.right, right)
+        _update(left)
+        return left
+    right.left = _merge(left, right.left)
+    _update(right)
+    return right
+
+
+def _split(node, count):
+    """Splits a treap into its first `count` songs and the rest."""
+    if not node:
+        return None, None
+    left_size = node.left.size if node.left else 0
+    if left_size >= count:
+        left, node.left = _split(node.left, count)
+        _update(node)
+        if left:
+            left.parent = None
+        return left, node
+    node.right, right = _split(node.right, count - left_size - 1)
+    _update(node)
+    if right:
+        right.parent = None
+    return node, right
+
+
+class SongQueue:
+    """A sequence of songs, stored as an implicit treap.
+
+    Getting, inserting, removing and moving songs by position, and finding a
+    song's position, take O(log n) time, so nothing has to store its own
+    position. A song can only be in the queue once.
+    """
+
+    def __init__(self, songs=()):
+        self._root = None
+        self._nodes = {}
+        # Goes up with every change, so views of the queue know they're stale.
+        self.version = 0
+        # Called with every change, as ("insert", index, song), ("pop", index)
+        # or ("clear",), e.g. to save the queue.
+        self.on_change = None
+        for song in songs:
+            self.append(song)
+
+    def __len__(self):
+        return _size(self._root)
+
+    def __iter__(self):
+        return self.iterate()
+
+    def iterate(self, start=0):
+        """Yields the songs from position `start` on."""
+        # The stack holds the songs still to come whose right subtrees haven't
+        # been visited yet, the next one on top.
+        stack = []
+        node = self._root
+        while node:
+            left = node.left.size if node.left else 0
+            if start <= left:
+                stack.append(node)
+                if start == left:
+                    break
+                node = node.left
+            else:
+                start -= left + 1
+                node = node.right
+        while stack:
+            node = stack.pop()
+            yield node.song
+            node = node.right
+            while node:
+                stack.append(node)
+                node = node.left
+
+    def __contains__(self, song):
+        return song in self._nodes
+
+    def _index(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("queue index out of range")
+        return index
+
+    def __getitem__(self, index):
+        index = self._index(index)
+        node = self._root
+        while True:
+            left = _size(node.left)
+            if index < left:
+                node = node.left
+            elif index == left:
+                return node.song
+            else:
+                index -= left + 1
+                node = node.right
+
+    def __delitem__(self, index):
+        self.pop(index)
+
+    def insert(self, index, song):
+        """Inserts a song before `index`, like list.insert."""
+        if song in self._nodes:
+            raise ValueError("song is already queued")
+        index = max(0, min(len(self), index + len(self) if index < 0 else index))
+        node = self._nodes[song] = _Node(song)
+        if index == len(self):
+            self._root = _merge(self._root, node)
+        else:
+            left, right = _split(self._root, index)
+            self._root = _merge(_merge(left, node), right)
+        self._root.parent = None
+        self.version += 1
+        if self.on_change:
+            self.on_change("insert", index, song)
+
+    def append(self, song):
+        self.insert(len(self), song)
+
+    def appendleft(self, song):
+        self.insert(0, song)
+
+    def pop(self, index=-1):
+        index = self._index(index)
+        left, rest = _split(self._root, index)
+        node, right = _split(rest, 1)
+        self._root = _merge(left, right)
+        if self._root:
+            self._root.parent = None
+        del self._nodes[node.song]
+        self.version += 1
+        if self.on_change:
+            self.on_change("pop", index)
+        return node.song
+
+    def popleft(self):
+        return self.pop(0)
+
+    def index(self, song):
+        """Returns the position of a song in the queue, counting from 0."""
+        node = self._nodes[song]
+        index = _size(node.left)
+        while node.parent:
+            if node is node.parent.right:
+                index += _size(node.parent.left) + 1
+            node = node.parent
+        return index
+
+    def remove(self, song):
+        self.pop(self.index(song))
+
+    def move(self, old, new):
+        """Moves the song at position `old` to position `new` and returns it."""
+        song = self.pop(old)
+        self.insert(new, song)
+        return song
+
+    def clear(self):
+        self._root = None
+        self._nodes.clear()
+        self.version += 1
+        if self.on_change:
+            self.on_change("clear")
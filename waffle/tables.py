@@ -1,4 +1,4 @@
-from sqlalchemy import Table, Integer, String, Column, DateTime, PickleType
+from sqlalchemy import Table, Integer, String, Column, DateTime, PickleType, Index, JSON
 import waffle.database
 
 metadata = waffle.database.metadata
@@ -6,10 +6,63 @@ metadata = waffle.database.metadata
 TasksTable = Table(
     "tasks",
     metadata,
+    Column("id", Integer, primary_key=True),
     Column("guild_id", Integer),
-    Column("message_id", Integer, primary_key=True),
+    Column("message_id", Integer),
     Column("channel_id", Integer),
     Column("time", DateTime, nullable=False),
     Column("function", String(32), nullable=False),
     Column("user_id", Integer),
+    Column("moderator_id", Integer),
+    Column("reason", String(512)),
+    Column("payload", JSON),
+    Column("interval", Integer),
+    Column("key", String(64), unique=True),
+    Column("worker_id", String(64)),
+    Column("lease_expires", DateTime),
+    Index("ix_tasks_time", "time"),
+    Index("ix_tasks_guild_id_time", "guild_id", "time"),
+    Index("ix_tasks_lease_expires", "lease_expires"),
+)
+
+SongsTable = Table(
+    "songs",
+    metadata,
+    Column("id", String(32), primary_key=True),
+    Column("webpage_url", String(256)),
+    Column("title", String(256)),
+    Column("duration", Integer),
+    Column("uploader", String(256)),
+    Column("channel_url", String(256)),
+    Column("artist", String(256)),
+    Column("updated", DateTime, nullable=False),
+    Index("ix_songs_updated", "updated"),
+)
+
+SongQueriesTable = Table(
+    "song_queries",
+    metadata,
+    Column("query", String(256), primary_key=True),
+    Column("video_id", String(32), nullable=False),
+    Column("updated", DateTime, nullable=False),
+    Index("ix_song_queries_updated", "updated"),
+)
+
+# A guild's music queue as of change `sequence`, and the changes since, in
+# rows of changes recorded together, numbered after their last change.
+MusicQueuesTable = Table(
+    "music_queues",
+    metadata,
+    Column("guild_id", Integer, primary_key=True),
+    Column("sequence", Integer, nullable=False),
+    Column("state", JSON, nullable=False),
+    Column("updated", DateTime, nullable=False),
+)
+
+MusicQueueChangesTable = Table(
+    "music_queue_changes",
+    metadata,
+    Column("guild_id", Integer, primary_key=True),
+    Column("sequence", Integer, primary_key=True),
+    Column("changes", JSON, nullable=False),
 )